@@ -3,12 +3,11 @@ import sys
 import logging
 from .log import Log
 
-# NOTE: to enable tracebacks, set the logger level to logging.DEBUG
+# NOTE: to enable tracebacks, set the application log level to logging.DEBUG
 # and set ENABLE_TRACEBACKS to True
 ENABLE_TRACEBACKS = False
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
 
 class Debug:
     """ Class that demonstrates logging at different levels"""
@@ -22,15 +21,22 @@ class Debug:
         logger.critical('logging.CRITICAL from DebugClass')
 
 
-    def write_traceback_to_log(self):
+    def write_traceback_to_log(self, enabled=ENABLE_TRACEBACKS):
         """
         Print detailed information about an exception, including the file, class, and line number where it occurred, 
         along with a stack trace.
+
+        ENABLE_TRACEBACKS is bound as a default argument when the module is loaded,
+        so the check is a local lookup on the exception path.
         """
-        if not ENABLE_TRACEBACKS:
+        if not enabled:
             logger.debug('Tracebacks are disabled')
             return
 
+        # Formatting the traceback can be expensive, so don't bother if it won't be logged
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+
         # Fetching the current exception information
         exc_type, exc_value, exc_traceback = sys.exc_info()
 
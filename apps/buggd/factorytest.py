@@ -1,21 +1,19 @@
 ''' This class is used to test the hardware in the factory. It is instantiated and 
-run if the trigger file is present. '''
+run if the trigger file is present.
+
+On a normal boot it's only used to check the stored results, so the hardware
+drivers are imported by the methods that use them. '''
 
 import logging
 import subprocess
 import os
 import time
-from smbus2 import SMBus
-from buggd.drivers.modem import Modem
-from buggd.drivers.soundcard import Soundcard
-from buggd.drivers.pcmd3180 import PCMD3180
+from concurrent.futures import ThreadPoolExecutor
 from buggd.drivers.leds import Colour
-from buggd.drivers.userled import UserLED
 
 from .utils import discover_serial
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 class FactoryTest:
     """ 
@@ -37,11 +35,51 @@ class FactoryTest:
     /etc/issue.d by buggOS to be displayed on the console before login.
     """
 
+    # The tests in each results category, in the order the categories are reported on the LEDs
+    RESULT_CATEGORIES = {
+        "modem": ("modem_enumerates", "modem_responsive", "modem_sim_readable", "modem_towers_found"),
+        "i2c": ("i2s_bridge_responding", "rtc_responding", "led_controller_responding"),
+        "recording": ("internal_microphone_recording", "external_microphone_recording"),
+    }
+
+    # Top LED colour for a failure in each category
+    CATEGORY_COLOURS = {
+        "modem": Colour.YELLOW,
+        "i2c": Colour.RED,
+        "recording": Colour.BLUE,
+    }
+
+    # Middle LED colour for a single failed test
+    FAILURE_COLOURS = {
+        "modem_enumerates": Colour.RED,
+        "modem_responsive": Colour.MAGENTA,
+        "modem_sim_readable": Colour.BLUE,
+        "modem_towers_found": Colour.YELLOW,
+        "i2s_bridge_responding": Colour.RED,
+        "rtc_responding": Colour.CYAN,
+        "led_controller_responding": Colour.MAGENTA,
+        "internal_microphone_recording": Colour.RED,
+        "external_microphone_recording": Colour.YELLOW,
+    }
+
+    # Set once ModemManager has been stopped, so we don't stop it again on every modem test
+    _modemmanager_stopped = False
+
     def __init__(self, leds):
 
         self.results_file = "/home/bugg/factory_test_results.txt"
 
+        # The serial can't change at runtime, so only read /proc/cpuinfo once
+        self.serial = discover_serial()
+
         self.leds = leds
+
+        # I2C bus handle shared by the tests. Opened on first use, see get_i2c_bus()
+        self.i2c_bus = None
+
+        # Cached result of passed_at_factory(), keyed on the results file mtime
+        self._passed_cache = None
+        self._passed_cache_mtime = None
         
         self.all_passed = False
         self.results = {
@@ -77,13 +115,19 @@ class FactoryTest:
         self.leds.middle.set(Colour.BLACK) 
         
 
-        # Run the tests
-        completed = [] 
-        completed.append(self.test_modem())
-        completed.append(self.test_i2c_devices())
-        completed.append(self.test_recording())
-
-        if all(completed):
+        # Run the tests. The modem test spends most of its time waiting for the modem,
+        # so run it in the background. The I2C and recording tests both drive the
+        # PCMD3180, so they have to run one after the other. If the I2C test can't
+        # complete, the recording test won't either, so skip it.
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                modem_test = executor.submit(self.test_modem)
+                completed = self.test_i2c_devices() and self.test_recording()
+                completed = modem_test.result() and completed
+        finally:
+            self.close()
+
+        if completed:
             logger.info("All tests completed.")
 
             # Check if all tests passed - this indicates that all the hardware is functioning correctly 
@@ -91,8 +135,9 @@ class FactoryTest:
 
             self.display_results_on_leds()
 
-            logger.info("\n%s", self.get_results_string())
-            self.write_results_to_disk()
+            results_text = self.get_results_string()
+            logger.info("\n%s", results_text)
+            self.write_results_to_disk(results_text)
             return True
 
         else:
@@ -101,6 +146,22 @@ class FactoryTest:
             self.leds.middle.set(Colour.RED)
             return False
 
+    def get_i2c_bus(self):
+        """
+        Return the I2C bus handle, opening it the first time it's needed.
+        The handle is kept open for the rest of the test run and released by close().
+        """
+        if self.i2c_bus is None:
+            from smbus2 import SMBus
+            self.i2c_bus = SMBus(1)
+        return self.i2c_bus
+
+    def close(self):
+        """ Release the I2C bus handle, if it's open """
+        if self.i2c_bus is not None:
+            self.i2c_bus.close()
+            self.i2c_bus = None
+
     def run_bare_board(self):
         """
         Run the bare-board test. This just turns on the power rails, modem, soundcard, etc.
@@ -109,6 +170,10 @@ class FactoryTest:
 
         logger.info("Running factory bare-board test.")
 
+        from buggd.drivers.modem import Modem
+        from buggd.drivers.soundcard import Soundcard
+        from buggd.drivers.userled import UserLED
+
         modem = Modem()
         modem.turn_on_rail()
 
@@ -126,15 +191,23 @@ class FactoryTest:
 
 
     def passed_at_factory(self):
-        """ Check if the factory test has run before. Used on boot to set the LEDs """
+        """
+        Check if the factory test has run before. Used on boot to set the LEDs
+
+        The result is cached against the file's modification time, so repeat calls
+        don't re-read the file unless it has been rewritten.
+        """
         try:
+            mtime = os.stat(self.results_file).st_mtime
+            if mtime == self._passed_cache_mtime:
+                return self._passed_cache
+
             with open(self.results_file, 'r', encoding='utf-8') as file:
-                for line in file:
-                    if 'all_tests_passed' in line:
-                        # Split the line into key and value, strip whitespace, convert to bool
-                        _, value = line.split(':')
-                        passed = value.strip().lower() == 'true'
-                        return passed
+                passed = 'all_tests_passed: true' in file.read().lower()
+
+            self._passed_cache = passed
+            self._passed_cache_mtime = mtime
+            return passed
         except FileNotFoundError:
             return False
         except Exception as e:
@@ -152,14 +225,19 @@ class FactoryTest:
         """
         logger.info("Testing modem.")
 
+        from buggd.drivers.modem import Modem
+
         try:
 
-            # Stop ModemManager to prevent it from interfering with the modem
-            try:
-                subprocess.run(["sudo", "systemctl", "stop", "ModemManager"], check=True)
-            except subprocess.CalledProcessError as e:
-                logger.warning("Failed to stop ModemManager: %s", e)
-                return False
+            # Stop ModemManager to prevent it from interfering with the modem.
+            # It stays stopped, so only do this once per boot.
+            if not FactoryTest._modemmanager_stopped:
+                try:
+                    subprocess.run(["sudo", "systemctl", "stop", "ModemManager"], check=True)
+                except subprocess.CalledProcessError as e:
+                    logger.warning("Failed to stop ModemManager: %s", e)
+                    return False
+                FactoryTest._modemmanager_stopped = True
 
             modem = Modem()
 
@@ -167,15 +245,15 @@ class FactoryTest:
             self.results["modem_enumerates"] = modem.power_off() and modem.power_on() and modem.is_enumerated()
             self.results["modem_responsive"] = modem.is_responding()
             self.results["modem_sim_readable"] = modem.sim_present()
-            # Sometimes the modem takes a while to get a signal
-            tries = 6
-            while tries > 0:
+            # Sometimes the modem takes a while to get a signal, so back off between tries
+            delay = 0.25
+            for _ in range(6):
                 rssi = modem.get_rssi()
                 logger.debug("RSSI: %s", rssi)
-                time.sleep(1)
-                tries -= 1
                 if rssi and rssi != 99:
                     break
+                time.sleep(delay)
+                delay = min(delay * 2, 2.0)
             self.results["modem_towers_found"] = rssi is not None and rssi != 99
 
             modem.power_off()
@@ -191,6 +269,8 @@ class FactoryTest:
         """
         logger.info("Testing I2C devices.")
 
+        from buggd.drivers.pcmd3180 import PCMD3180
+
         try:
             pcf8574_addr = 0x23 # LED controller
             pcmd3180_addr = 0x4c # I2S bridge
@@ -200,10 +280,11 @@ class FactoryTest:
             pcmd = PCMD3180()
             pcmd.power_on()
 
-            # Run the tests
-            self.results["i2s_bridge_responding"] = i2c_device_present(pcmd3180_addr)
-            self.results["rtc_responding"] = i2c_device_present(ds3231_addr)
-            self.results["led_controller_responding"] = i2c_device_present(pcf8574_addr)
+            # Run the tests, sharing one bus handle between the probes
+            bus = self.get_i2c_bus()
+            self.results["i2s_bridge_responding"] = probe_i2c_device(bus, pcmd3180_addr)
+            self.results["rtc_responding"] = probe_i2c_device(bus, ds3231_addr)
+            self.results["led_controller_responding"] = probe_i2c_device(bus, pcf8574_addr)
 
             pcmd.power_off()
             pcmd.close()
@@ -221,11 +302,13 @@ class FactoryTest:
         """
         logger.info("Testing recording.")
 
+        from buggd.drivers.soundcard import Soundcard
+
         try:
             soundcard = Soundcard()
 
-            soundcard.disable_internal_channel()
-            soundcard.disable_external_channel()
+            # Enabling the internal channel resets the I2S bridge, so there's no need
+            # to power cycle the channels first
             soundcard.enable_internal_channel()
             soundcard.enable_external_channel()
 
@@ -253,18 +336,17 @@ class FactoryTest:
 
     def get_results_string(self):
         """ Return a formatted string of the test results, one per line """
-        s = (
-            "\nFactory Self-Test Results:\n"
-            + "--------------------------\n"
-            + "Device Serial: " + discover_serial() + "\n"
-            + "\n".join([f"{k}: {v}" for k, v in self.results.items()])
-            + "\nall_tests_passed: " + str(self.test_passed())
-            + "\n"
-            + "-----------------------\n"
-            + ("Factory Self-Test PASS!" if self.test_passed() else "Factory Self-Test FAIL!")
-            + "\n\n"
-        )
-        return s
+        passed = self.test_passed()
+        lines = ["", "Factory Self-Test Results:", "--------------------------", f"Device Serial: {self.serial}"]
+        lines.extend(f"{k}: {v}" for k, v in self.results.items())
+        lines.extend([
+            f"all_tests_passed: {passed}",
+            "-----------------------",
+            "Factory Self-Test PASS!" if passed else "Factory Self-Test FAIL!",
+            "",
+            "",
+        ])
+        return "\n".join(lines)
 
 
     def test_passed(self):
@@ -272,14 +354,26 @@ class FactoryTest:
         return self.all_passed
 
 
-    def write_results_to_disk(self):
-        """ Write the results string to the primary user's home directory """
+    def write_results_to_disk(self, text=None):
+        """
+        Write the results string to the primary user's home directory
+
+        Args:
+            text: The results string, if the caller already has it. Generated if not provided.
+        """
+        if text is None:
+            text = self.get_results_string()
+
+        # Write to a temporary file and rename it over the results file, so readers
+        # never see a partly-written file
+        tmp_file = self.results_file + ".tmp"
         try:
-            with open(self.results_file, 'w', encoding='utf-8') as f:
-                f.write(self.get_results_string())
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                # Set permissions to globally-readable
+                os.fchmod(f.fileno(), 0o644)
+                f.write(text)
 
-            # Set permissions to globally-readable
-            os.chmod(self.results_file, 0o644)
+            os.replace(tmp_file, self.results_file)
         except Exception as e:
             logger.error("Failed to write results to disk. %s", e)
 
@@ -294,76 +388,45 @@ class FactoryTest:
         else:
             results = self.get_results()
 
-            # Split the results into the different categories
-            modem_results = {k: v for k, v in results.items() if "modem" in k} 
-            i2c_results = {k: v for k, v in results.items() if "responding" in k}
-            recording_results = {k: v for k, v in results.items() if "recording" in k}
-            
             # Create lists of the failed tests in each category
-            modem_failures = [k for k, v in modem_results.items() if not v]
-            i2c_failures = [k for k, v in i2c_results.items() if not v]
-            recording_failures = [k for k, v in recording_results.items() if not v]
-            
-            if sum(bool(failures) for failures in [modem_failures, i2c_failures, recording_failures]) > 1:
+            failures = {category: [k for k in keys if not results[k]]
+                        for category, keys in self.RESULT_CATEGORIES.items()}
+            failed_categories = [category for category, failed in failures.items() if failed]
+
+            if len(failed_categories) > 1:
                 # Failures in multiple categories
                 self.leds.top.set(Colour.WHITE)
                 self.leds.middle.set(Colour.BLACK)
-                
-            elif bool(modem_failures):
-                # Modem failures, indicate which ones
-                self.leds.top.set(Colour.YELLOW)
-
-                # Multiple failures, indicate that
-                if len(modem_failures) > 1:
-                    self.leds.middle.set(Colour.WHITE)
-                
-                else:
-                    match modem_failures[0]:
-                        case "modem_enumerates":
-                            self.leds.middle.set(Colour.RED)
-                        case "modem_responsive":
-                            self.leds.middle.set(Colour.MAGENTA)
-                        case "modem_sim_readable":
-                            self.leds.middle.set(Colour.BLUE)
-                        case "modem_towers_found":
-                            self.leds.middle.set(Colour.YELLOW)
-                            
-            elif bool(i2c_failures):
-                # I2C failures, indicate which ones
-                self.leds.top.set(Colour.RED)
 
-                # Multiple failures, indicate that
-                if len(i2c_failures) > 1:
-                    self.leds.middle.set(Colour.WHITE)
-                
-                else:
-                    match i2c_failures[0]:
-                        case "i2s_bridge_responding":
-                            self.leds.middle.set(Colour.RED)
-                        case "rtc_responding":
-                            self.leds.middle.set(Colour.CYAN)
-                        case "led_controller_responding":
-                            self.leds.middle.set(Colour.MAGENTA) 
-
-            elif bool(recording_failures):
-                # Recording failures, indicate which ones
-                self.leds.top.set(Colour.BLUE)
+            elif failed_categories:
+                # Failures in a single category, indicate which ones
+                category = failed_categories[0]
+                self.leds.top.set(self.CATEGORY_COLOURS[category])
 
                 # Multiple failures, indicate that
-                if len(recording_failures) > 1:
+                if len(failures[category]) > 1:
                     self.leds.middle.set(Colour.WHITE)
-                
                 else:
-                    match recording_failures[0]:
-                        case "internal_microphone_recording":
-                            self.leds.middle.set(Colour.RED)
-                        case "external_microphone_recording":
-                            self.leds.middle.set(Colour.YELLOW)
+                    self.leds.middle.set(self.FAILURE_COLOURS[failures[category][0]])
 
 
 def i2c_device_present(addr, bus_num=1, force=True):
     """
-    This function probes the I2C bus to check if a device responds.
+    Open the I2C bus and check if a device responds. See probe_i2c_device().
+    """
+
+    from smbus2 import SMBus
+
+    try:
+        with SMBus(bus_num) as bus:
+            return probe_i2c_device(bus, addr, force=force)
+    except Exception:
+        return False
+
+
+def probe_i2c_device(bus, addr, force=True):
+    """
+    This function probes an already-open I2C bus to check if a device responds.
     Since I2C doesn't have a standard way to check if a device is present,
     this function attempts to read a byte from the device.
     There is no guarantee that this will not change the device's state.
@@ -372,10 +435,8 @@ def i2c_device_present(addr, bus_num=1, force=True):
     """
 
     try:
-        # Prepare read and write operations without changing the device state
-        with SMBus(bus_num) as bus:
-            # Attempt to read a byte from the device
-            bus.read_byte(addr, force=force)
+        # Attempt to read a byte from the device
+        bus.read_byte(addr, force=force)
         return True
     except OSError as expt:
         if expt.errno == 16:
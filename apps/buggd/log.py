@@ -39,6 +39,11 @@ class Log:
         # Create log directory if it doesn't exist
         os.makedirs(self.log_dir, exist_ok=True)
 
+        # None of our formatters use the thread or process fields, so don't collect them for every record
+        logging.logThreads = False
+        logging.logProcesses = False
+        logging.logMultiprocessing = False
+
         # Configure the root logger
         self.logger = logging.getLogger()
 
@@ -57,6 +62,7 @@ class Log:
 
         # Handler for file is created in rotate_log()
         self.file_handler = None
+        self.last_rotate_t = None
         self.rotate_log()
 
         self.logger.info('Logging to stdout started')
@@ -78,10 +84,16 @@ class Log:
         fn = f'rpi_eco_{self.cpu_serial}_{start_time}.log'
         return os.path.join(self.log_dir, fn)
 
-    def rotate_log(self):
+    def rotate_log(self, min_interval_s=0):
         """
         Rotate the log file by closing the current one and creating a new one.
+        Does nothing if the current file was opened less than min_interval_s seconds ago.
         """
+        now = time.monotonic()
+        if self.file_handler and now - self.last_rotate_t < min_interval_s:
+            return
+        self.last_rotate_t = now
+
         if self.file_handler:
             self.logger.removeHandler(self.file_handler)
             self.file_handler.close()
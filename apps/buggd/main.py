@@ -2,6 +2,7 @@ import os
 import sys
 import time
 import signal
+import socket
 import threading
 import datetime as dt
 import json
@@ -11,9 +12,13 @@ import atexit
 import traceback
 import requests
 import queue
+import random
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from importlib import metadata
 from google.cloud import storage
-from pcf8574 import PCF8574
 
 import websocket  # pip install websocket-client
 from buggd import sensors
@@ -22,7 +27,7 @@ from buggd.drivers.userled import UserLED
 from buggd.drivers.leds import LEDs, Colour
 
 from .utils import call_cmd_line, mount_ext_sd, copy_sd_card_config, discover_serial, clean_dirs, check_sd_not_corrupt, merge_dirs
-from .utils import check_internet_conn, update_time, set_led,  wait_for_internet_conn, check_reboot_due
+from .utils import check_internet_conn, update_time, set_led, set_leds_multi, wait_for_internet_conn, check_reboot_due, tune_writeback
 from .factorytest import FactoryTest
 from .log import Log
 from .debug import Debug
@@ -41,8 +46,6 @@ REBOOT_TIME_UTC = dt.time(2, 0, 0)
 ERROR_WAIT_REBOOT_S = 300
 
 # GPIO information for the LED driver and LED colours
-PCF8574_I2C_ADD = 0x23
-PCF8574_I2C_BUS = 1
 REC_LED_CHS = (7, 6, 5)
 DATA_LED_CHS = (4, 3, 2)
 PWR_LED_CHS = (1, 0)
@@ -58,8 +61,50 @@ LED_ALL_ON = (1, 1, 1)
 LED_ALL_OFF = (0, 0, 0)
 PWR_LED_ON = (0, 0)
 
+# HTTP upload settings: connection pool size, retries on connection errors,
+# and (connect, read) timeouts in seconds
+UPLOAD_POOL_SIZE = 4
+UPLOAD_RETRIES = 3
+UPLOAD_TIMEOUT_S = (10, 120)
+
+# Maximum number of files and total size of a single upload request. The server
+# must accept several 'file' parts per request before UPLOAD_BATCH_MAX_FILES is raised above 1
+UPLOAD_BATCH_MAX_FILES = 1
+UPLOAD_BATCH_MAX_BYTES = 32 * 1024 * 1024
+
+# How long the websocket uploaders wait on their queue before checking for shutdown,
+# and how long the connection can be idle before it's pinged to check it's still alive
+WS_QUEUE_TIMEOUT_S = 1
+WS_PING_INTERVAL_S = 30
+
+# Size of the fragments files are sent over the websocket in
+WS_SEND_CHUNK_BYTES = 256 * 1024
+
+# Kernel send buffer for the websocket, so a large audio message can be queued
+# with fewer blocking send() calls
+WS_SNDBUF_BYTES = 1024 * 1024
+
+# Websocket reconnects back off exponentially from 1 second up to this limit
+WS_RECONNECT_MAX_S = 60
+
+# How often the HTTP mode uploader rechecks for shutdown while waiting for a new recording
+UPLOAD_WAIT_S = 5
+
+# How many captured recordings can wait for postprocessing before recording blocks
+POSTPROCESS_QUEUE_SIZE = 2
+
+# How many stream chunks (0.3s each) can wait between the capture, encode and upload
+# threads. When full the producer blocks instead of the backlog growing without bound
+STREAM_QUEUE_SIZE = 50
+
+# Start a new log file at most this often, rather than on every server sync
+LOG_ROTATE_INTERVAL_S = 3600
+
 CONFIG_FNAME = 'config.json'
 
+# Installed package version, looked up once as importlib.metadata scans the dist-info dirs
+BUGGD_VERSION = metadata.version('buggd')
+
 SD_MNT_LOC = '/mnt/sd/'
 FACTORY_TEST_TRIGGER_FULL = '/mnt/sd/factory-test-full.txt'
 FACTORY_TEST_TRIGGER_BARE_BOARD = '/mnt/sd/factory-test-bare.txt'
@@ -68,6 +113,12 @@ GLOB_no_sd_mode = False
 GLOB_is_connected = False
 #TODO: make offline mode a configurable parameter from the config.json file
 GLOB_offline_mode = False
+# Set by the SIGINT handler to tell the recording and upload threads to shut down
+GLOB_die = threading.Event()
+# Set when upload_dir may hold files that haven't been uploaded yet: at startup,
+# after each recording is postprocessed, and after a failed upload
+GLOB_upload_pending = threading.Event()
+GLOB_upload_pending.set()
 
 leds = LEDs() # Make the LEDs object global so it can be accessed by the cleanup function
 log = Log() # Make the Log object global
@@ -84,6 +135,22 @@ MODE_HTTP = 1
 MODE_WEBSOCKET_SAFE = 2
 MODE_CONTINUOUS_STREAM = 3
 
+# The parsed config file and the modification time it was read at. See get_config()
+_config_cache = {'mtime_ns': None, 'config': None}
+
+
+def get_config():
+    """
+    Return the parsed config file. The file is only re-read if it has been
+    modified since the last call, e.g. by a new config being copied from the SD card.
+    """
+    mtime_ns = os.stat(CONFIG_FNAME).st_mtime_ns
+    if mtime_ns != _config_cache['mtime_ns']:
+        with open(CONFIG_FNAME) as cfgf:
+            _config_cache['config'] = json.load(cfgf)
+        _config_cache['mtime_ns'] = mtime_ns
+    return _config_cache['config']
+
 
 """
 Running the recording process uses the following functions, which users
@@ -133,7 +200,7 @@ def auto_sys_config(sd_mnt_dir, use_sd_card):
     cpu_id = discover_serial()
     # If there's a config file get the project and config IDs
     if os.path.exists(CONFIG_FNAME):
-        dev_config = json.load(open(CONFIG_FNAME))['device']
+        dev_config = get_config()['device']
         proj_id = dev_config['project_id']
         conf_id = dev_config['config_id']
 
@@ -154,7 +221,7 @@ def auto_configure_sensor():
 
     # Get sensor configuration from config file if exists
     if os.path.exists(CONFIG_FNAME):
-        config = json.load(open(CONFIG_FNAME))
+        config = get_config()
         sensor_config = config['sensor']
         sensor_type = sensor_config['sensor_type']
         logger.info('Found local config file - configuring {} with settings from file'.format(sensor_type))
@@ -191,7 +258,7 @@ def auto_configure_sensor():
     return sensor
 
 
-def record_sensor(sensor, working_dir, data_dir, led_driver):
+def record_sensor(sensor, working_dir, data_dir, led_driver, postprocess_q=None):
 
     """
     Function to run the common sensor record loop. The sleep between
@@ -201,6 +268,8 @@ def record_sensor(sensor, working_dir, data_dir, led_driver):
         working_dir: The working directory to be used by the sensor
         data_dir: The data directory to use for completed files
         led_driver: The I2C driver for the LEDs
+        postprocess_q: Queue read by a postprocess_worker() thread. If None, the
+        recording is postprocessed in a new thread
     """
 
     # Capture data from the sensor
@@ -214,9 +283,13 @@ def record_sensor(sensor, working_dir, data_dir, led_driver):
     if check_reboot_due(REBOOT_TIME_UTC):
         cmd_on_complete = 'sudo reboot'
 
-    # Postprocess the raw data in a separate thread
-    postprocess_t = threading.Thread(target=sensor.postprocess, args=(uncomp_f,cmd_on_complete,))
-    postprocess_t.start()
+    # Postprocess the raw data in a separate thread. The queue is bounded, so this
+    # blocks if postprocessing has fallen behind rather than piling up work
+    if postprocess_q is not None:
+        postprocess_q.put((uncomp_f, cmd_on_complete))
+    else:
+        postprocess_t = threading.Thread(target=sensor.postprocess, args=(uncomp_f,cmd_on_complete,))
+        postprocess_t.start()
 
     # Let the sensor sleep
     set_led(led_driver, REC_LED_CHS, REC_LED_SLEEP)
@@ -233,17 +306,130 @@ def exit_handler(signal, frame):
 
     logger.info('SIGINT detected, shutting down')
     # set the event to signal threads
-    raise StopMonitoring
+    GLOB_die.set()
+
+
+def create_upload_session():
+    """
+    Create a requests session for uploading to the Waraki server. The connection is
+    kept alive between uploads, and failed connections are retried with a backoff.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=UPLOAD_POOL_SIZE, pool_maxsize=UPLOAD_POOL_SIZE,
+                          max_retries=Retry(total=UPLOAD_RETRIES, backoff_factor=0.5))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def scan_upload_files(upload_dir):
+    """
+    Recursively find the files to upload in upload_dir, skipping logs and
+    files still being written (named with a leading '.', see partial_path())
+
+    Uses os.scandir so the file type comes from the directory listing
+    rather than a separate stat of every entry.
+
+    Yields:
+        (path, size) for each file
+    """
+    subdirs = []
+    with os.scandir(upload_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif (entry.is_file(follow_symlinks=False) and not entry.name.endswith('.log')
+                  and not entry.name.startswith('.')):
+                yield entry.path, entry.stat(follow_symlinks=False).st_size
+
+    for subdir in subdirs:
+        yield from scan_upload_files(subdir)
+
+
+def upload_to_waraki(session, upload_url, upload_dir):
+    """
+    Upload every file (apart from logs) in upload_dir to the Waraki server,
+    deleting each file once it has been uploaded. Files are sent in batches
+    of up to UPLOAD_BATCH_MAX_FILES files / UPLOAD_BATCH_MAX_BYTES bytes per request.
+
+    Parameters:
+        session: The requests session to upload with, see create_upload_session()
+        upload_url: The URL of the Waraki upload endpoint
+        upload_dir: The upload directory to synchronise
+
+    Returns:
+        True if every file was uploaded
+    """
+    all_uploaded = True
+    batch = []
+    batch_bytes = 0
+    for local_path, size in scan_upload_files(upload_dir):
+        # Send the current batch if this file won't fit in it
+        if batch and (len(batch) >= UPLOAD_BATCH_MAX_FILES or batch_bytes + size > UPLOAD_BATCH_MAX_BYTES):
+            all_uploaded &= upload_batch_to_waraki(session, upload_url, batch)
+            batch = []
+            batch_bytes = 0
+
+        batch.append(local_path)
+        batch_bytes += size
+
+    if batch:
+        all_uploaded &= upload_batch_to_waraki(session, upload_url, batch)
 
-class StopMonitoring(Exception):
+    return all_uploaded
 
+
+def upload_pending_to_waraki(session, upload_url, upload_dir):
+    """
+    Run upload_to_waraki() only if GLOB_upload_pending says there may be new
+    files, so upload_dir isn't walked again when nothing has changed
     """
-    This is a custom exception that gets thrown by the exit handler
-    when SIGINT is detected. It allows a loop within a try/except block
-    to break out and set the event to shutdown cleanly
+    if not GLOB_upload_pending.is_set():
+        logger.info('No new files to upload')
+        return
+
+    # Clear before scanning so a recording finished during the scan is picked up next time
+    GLOB_upload_pending.clear()
+    try:
+        all_uploaded = upload_to_waraki(session, upload_url, upload_dir)
+    except Exception:
+        GLOB_upload_pending.set()
+        raise
+
+    if not all_uploaded:
+        GLOB_upload_pending.set()
+
+
+def upload_batch_to_waraki(session, upload_url, local_paths):
     """
+    Upload a batch of files to the Waraki server in a single request,
+    and delete them if the upload succeeded
 
-    pass
+    Parameters:
+        session: The requests session to upload with, see create_upload_session()
+        upload_url: The URL of the Waraki upload endpoint
+        local_paths: The paths of the files to upload
+
+    Returns:
+        True if the upload succeeded
+    """
+    names = ', '.join(os.path.basename(local_path) for local_path in local_paths)
+    logger.info('Uploading %s to Waraki...', names)
+    try:
+        with ExitStack() as stack:
+            file_payload = [('file', (os.path.basename(local_path), stack.enter_context(open(local_path, 'rb'))))
+                            for local_path in local_paths]
+            data_payload = {'password' : 'soundscape'}
+            response = session.post(upload_url, files = file_payload, data = data_payload,
+                                    timeout=UPLOAD_TIMEOUT_S)
+        response.raise_for_status()
+        logger.info('Upload of %s to Waraki completed.', names)
+        for local_path in local_paths:
+            os.remove(local_path)
+        return True
+    except Exception as e:
+        logger.error('Failed to upload %s to Waraki. %s', names, e)
+        return False
 
 
 def default_waraki_server_sync(sync_interval, upload_dir, die, config_path, led_driver, modem, data_led_update_int, server_url):
@@ -262,6 +448,9 @@ def default_waraki_server_sync(sync_interval, upload_dir, die, config_path, led_
     global GLOB_is_connected
     global log
 
+    # Keep the HTTP connection alive between uploads
+    session = create_upload_session()
+
     # Sleep the thread and keep updating the data LED until the first upload cycle
     start_t = time.time()
     start_offs = sync_interval/2
@@ -299,27 +488,10 @@ def default_waraki_server_sync(sync_interval, upload_dir, die, config_path, led_
             # Set the LED to uploading colour
             set_led(led_driver, DATA_LED_CHS, DATA_LED_UPLOADING)
 
-            log.rotate_log()
+            log.rotate_log(min_interval_s=LOG_ROTATE_INTERVAL_S)
 
             try:
-                # Get credentials from JSON file
-                upload_url = f"{server_url}/api/bugg/upload"
-                for root, subdirs, files in os.walk(upload_dir):
-                    for local_f in files:
-                        local_path = os.path.join(root, local_f)
-                        if local_f.endswith('.log'):
-                            continue    
-                        logger.info(f'Uploading {local_path} to Waraki...')
-                        try:
-                            with open(local_path, 'rb') as f:
-                                file_payload = {'file' : (local_f, f)}
-                                data_payload = {'password' : 'soundscape'}
-                                response = requests.post(upload_url, files = file_payload, data = data_payload)
-                            response.raise_for_status()                                
-                            logger.info(f'Upload of {local_f} to Waraki completed.')
-                            os.remove(local_path)
-                        except Exception as e:
-                            logger.error(f'Failed to upload {local_f} to Waraki. {e}')
+                upload_pending_to_waraki(session, f"{server_url}/api/bugg/upload", upload_dir)
 
             except Exception as e:
                 logger.info('Exception caught in gcs_server_sync: {}'.format(str(e)))
@@ -358,6 +530,9 @@ def waraki_server_sync(sync_interval, upload_dir, die, config_path, led_driver,
     global GLOB_is_connected
     global log
 
+    # Keep the HTTP connection alive between uploads
+    session = create_upload_session()
+
     # Sleep the thread and keep updating the data LED until the first upload cycle
     start_t = time.time()
     start_offs = sync_interval/2
@@ -374,6 +549,10 @@ def waraki_server_sync(sync_interval, upload_dir, die, config_path, led_driver,
 
     # keep running while the die is not set
     while not die.is_set():
+        # Wait until there's something to upload
+        if not GLOB_upload_pending.wait(UPLOAD_WAIT_S):
+            continue
+
         # Update sync start time
         start_t = time.time()
 
@@ -391,27 +570,10 @@ def waraki_server_sync(sync_interval, upload_dir, die, config_path, led_driver,
             # Set the LED to uploading colour
             set_led(led_driver, DATA_LED_CHS, DATA_LED_UPLOADING)
 
-            log.rotate_log()
+            log.rotate_log(min_interval_s=LOG_ROTATE_INTERVAL_S)
 
             try:
-                # Get credentials from JSON file
-                upload_url = f"{server_url}/api/bugg/upload"
-                for root, subdirs, files in os.walk(upload_dir):
-                    for local_f in files:
-                        local_path = os.path.join(root, local_f)
-                        if local_f.endswith('.log'):
-                            continue    
-                        logger.info(f'Uploading {local_path} to Waraki...')
-                        try:
-                            with open(local_path, 'rb') as f:
-                                file_payload = {'file' : (local_f, f)}
-                                data_payload = {'password' : 'soundscape'}
-                                response = requests.post(upload_url, files = file_payload, data = data_payload)
-                            response.raise_for_status()                                
-                            logger.info(f'Upload of {local_f} to Waraki completed.')
-                            os.remove(local_path)
-                        except Exception as e:
-                            logger.error(f'Failed to upload {local_f} to Waraki. {e}')
+                upload_pending_to_waraki(session, f"{server_url}/api/bugg/upload", upload_dir)
 
             except Exception as e:
                 logger.info('Exception caught in waraki_server_sync: {}'.format(str(e)))
@@ -434,6 +596,47 @@ def waraki_server_sync(sync_interval, upload_dir, die, config_path, led_driver,
         #logger.info('Waiting {} secs to next sync'.format(sync_wait))
         #time.sleep(max(0, sync_wait))
 
+def ws_send_file(ws, f, buf):
+    """
+    Send a file over the websocket as a single binary message, split into
+    fragments the size of buf so the whole file is never held in memory
+
+    Args:
+        ws: The websocket connection
+        f: The file to send, opened in binary mode
+        buf: A bytearray used as the read buffer
+    """
+    view = memoryview(buf)
+    remaining = os.fstat(f.fileno()).st_size
+    opcode = websocket.ABNF.OPCODE_BINARY
+    while True:
+        n = f.readinto(buf)
+        remaining -= n
+        fin = n == 0 or remaining <= 0
+        ws.send_frame(websocket.ABNF.create_frame(bytes(view[:n]), opcode, fin=int(fin)))
+        if fin:
+            break
+        # The rest of the message is sent as continuation frames
+        opcode = websocket.ABNF.OPCODE_CONT
+
+
+def ws_connect(uri):
+    """
+    Open the websocket used to upload audio. websocket-client never negotiates
+    permessage-deflate, which suits the already compressed audio.
+    """
+    return websocket.create_connection(uri, timeout=10, skip_utf8_validation=True,
+                                       sockopt=((socket.SOL_SOCKET, socket.SO_SNDBUF, WS_SNDBUF_BYTES),))
+
+
+def ws_reconnect_delay(attempt):
+    """
+    Exponential backoff with +/-20% jitter for the given reconnect attempt (from 0)
+    """
+    backoff = min(WS_RECONNECT_MAX_S, 2 ** attempt)
+    return backoff * (0.8 + 0.4 * random.random())
+
+
 def ws_uploader(uri, q: queue.Queue, led_driver, data_led_ch, stop_event):
     """ 
     Connect once, then loop: get filepath from q, send its bytes, delete on success.
@@ -441,27 +644,42 @@ def ws_uploader(uri, q: queue.Queue, led_driver, data_led_ch, stop_event):
     # set LED to “uploading”
     set_led(led_driver, data_led_ch, DATA_LED_UPLOADING)
 
+    # Files are sent in fragments through this buffer, rather than read into memory whole
+    send_buf = bytearray(WS_SEND_CHUNK_BYTES)
+
+    attempt = 0
     while not stop_event.is_set():
         try:
-            logger.info(f"[WS] Connecting to {uri}")
-            ws = websocket.create_connection(uri, max_size=None, timeout=10)
+            logger.info("[WS] Connecting to %s", uri)
+            ws = ws_connect(uri)
             logger.info("[WS] Connected")
+            attempt = 0
+            last_sent_t = time.time()
             while not stop_event.is_set():
-                filepath = q.get()
+                # Don't block forever, so a shutdown or a dead connection is noticed
+                try:
+                    filepath = q.get(timeout=WS_QUEUE_TIMEOUT_S)
+                except queue.Empty:
+                    if time.time() - last_sent_t >= WS_PING_INTERVAL_S:
+                        ws.ping()
+                        last_sent_t = time.time()
+                    continue
+                last_sent_t = time.time()
                 try:
                     with open(filepath, "rb") as f:
-                        data = f.read()
-                    ws.send_binary(data)
-                    logger.info(f"[WS] Sent & removed {filepath}")
+                        ws_send_file(ws, f, send_buf)
+                    logger.info("[WS] Sent & removed %s", filepath)
                     os.remove(filepath)
                 except Exception as e:
-                    logger.error(f"[WS] Error sending {filepath}: {e}")
+                    logger.error("[WS] Error sending %s: %s", filepath, e)
                 finally:
                     q.task_done()
             ws.close()
         except Exception as e:
-            logger.error(f"[WS] Connection error: {e}, retrying in 5s")
-            time.sleep(5)
+            delay = ws_reconnect_delay(attempt)
+            attempt += 1
+            logger.error("[WS] Connection error: %s, retrying in %.1fs", e, delay)
+            stop_event.wait(delay)
 
     # once stopped, reset LED
     set_led(led_driver, data_led_ch, DATA_LED_CONN)
@@ -473,26 +691,39 @@ def ws_uploader_continuous(uri, q, led_driver, data_led_ch, stop_event):
     Connect to the websocket and send to the server the bytes recorded
     """
     set_led(led_driver, data_led_ch, DATA_LED_UPLOADING)
+    attempt = 0
     while not stop_event.is_set():
         try:
-            logger.info(f"[WS] Connecting to {uri}")
-            ws = websocket.create_connection(uri, max_size=None, timeout=10)
+            logger.info("[WS] Connecting to %s", uri)
+            ws = ws_connect(uri)
             logger.info("[WS] Connected")
+            attempt = 0
+            last_sent_t = time.time()
             while not stop_event.is_set():
-                data = q.get()
+                # Don't block forever, so a shutdown or a dead connection is noticed
+                try:
+                    data = q.get(timeout=WS_QUEUE_TIMEOUT_S)
+                except queue.Empty:
+                    if time.time() - last_sent_t >= WS_PING_INTERVAL_S:
+                        ws.ping()
+                        last_sent_t = time.time()
+                    continue
+                last_sent_t = time.time()
                 try:
                     ws.send_binary(data)
-                    logger.info(f"[WS] Sent {len(data)} bytes")
+                    logger.debug("[WS] Sent %d bytes", len(data))
                 except Exception as e:
-                    logger.error(f"[WS] Error sending data : {e}")
+                    logger.error("[WS] Error sending data : %s", e)
                 finally:
                     q.task_done()
             ws.close() 
         except Exception as e:
-             logger.error(f"[WS] Connection error : {e}, retrying in 5 sec")
-             time.sleep(5)  
+             delay = ws_reconnect_delay(attempt)
+             attempt += 1
+             logger.error("[WS] Connection error: %s, retrying in %.1fs", e, delay)
+             stop_event.wait(delay)
     set_led(led_driver, data_led_ch, DATA_LED_CONN)
-    logger.info(f"[WS] Uploader thread exiting")
+    logger.info("[WS] Uploader thread exiting")
 
 def continuous_recording(sensor, working_dir, data_dir, led_driver, die):
 
@@ -507,16 +738,84 @@ def continuous_recording(sensor, working_dir, data_dir, led_driver, die):
         die: A threading event to terminate the server sync
     """
 
+    # Recordings are postprocessed by a single long-lived worker thread
+    postprocess_q = queue.Queue(maxsize=POSTPROCESS_QUEUE_SIZE)
+    postprocess_t = threading.Thread(target=postprocess_worker, args=(sensor, postprocess_q))
+    postprocess_t.start()
+
     try:
         # Start recording
         while not die.is_set():
             logger.info('GLOB_no_sd_mode: {}, GLOB_is_connected: {}, GLOB_offline_mode: {}'.format(GLOB_no_sd_mode, GLOB_is_connected, GLOB_offline_mode))
-            record_sensor(sensor, working_dir, data_dir, led_driver)
+            record_sensor(sensor, working_dir, data_dir, led_driver, postprocess_q)
     except Exception as e:
         logging.error('Caught exception on continuous_recording() function: {}'.format(str(e)))
         debug.write_traceback_to_log()
         # Blink error code on LEDs
         blink_error_leds(led_driver, e, dur=ERROR_WAIT_REBOOT_S)
+    finally:
+        # Let the recordings already captured finish postprocessing
+        postprocess_q.put(None)
+        postprocess_t.join()
+
+
+def postprocess_worker(sensor, postprocess_q):
+
+    """
+    Postprocess recordings from the queue until None is received. If recordings have
+    built up while one was being processed, they are all postprocessed concurrently,
+    and any commands to run on completion are run once the whole batch has finished
+
+    Args:
+        sensor: A instance of one of the sensor classes
+        postprocess_q: Queue of (uncompressed file name, command to run on completion) tuples
+    """
+
+    done = False
+    while not done:
+        batch = [postprocess_q.get()]
+        while True:
+            try:
+                batch.append(postprocess_q.get_nowait())
+            except queue.Empty:
+                break
+
+        if None in batch:
+            done = True
+            batch = batch[:batch.index(None)]
+
+        # Commands to run on completion (e.g. a scheduled reboot) wait until every
+        # recording in the batch is done, so none is cut off part way through
+        cmds_on_complete = [cmd for _, cmd in batch if cmd]
+        batch = [(uncomp_f, None) for uncomp_f, _ in batch]
+
+        if len(batch) == 1:
+            postprocess_one(sensor, batch[0])
+        elif batch:
+            # The work happens in ffmpeg subprocesses and file I/O, so threads are enough
+            with ThreadPoolExecutor(max_workers=len(batch)) as executor:
+                list(executor.map(lambda item: postprocess_one(sensor, item), batch))
+
+        for cmd in dict.fromkeys(cmds_on_complete):
+            call_cmd_line(cmd)
+
+
+def postprocess_one(sensor, item):
+
+    """
+    Postprocess one recording, logging rather than raising any error
+
+    Args:
+        sensor: A instance of one of the sensor classes
+        item: (uncompressed file name, command to run on completion) tuple
+    """
+
+    try:
+        sensor.postprocess(*item)
+        GLOB_upload_pending.set()
+    except Exception as e:
+        logger.error('Caught exception postprocessing {}: {}'.format(item[0], str(e)))
+        debug.write_traceback_to_log()
 
 
 def blink_error_leds(led_driver, error_e, dur=None):
@@ -543,8 +842,7 @@ def blink_error_leds(led_driver, error_e, dur=None):
             else: led_cols = LED_ALL_OFF
             state = not state
 
-            set_led(led_driver, REC_LED_CHS, led_cols)
-            set_led(led_driver, DATA_LED_CHS, led_cols)
+            set_leds_multi(led_driver, (REC_LED_CHS, led_cols), (DATA_LED_CHS, led_cols))
 
             time.sleep(1)
             running_t += 1
@@ -560,14 +858,20 @@ def blink_error_leds(led_driver, error_e, dur=None):
 
 
 
-def record_default_waraki(led_driver, modem):
+def setup_recording(led_driver, modem, force_online=False, require_connection=False):
     """
-    Function to setup, run and log continuous sampling from the sensor.
+    Setup shared by all the recording modes: power on the modem, mount the SD card,
+    load the config, wait for an internet connection, and prepare the data directories.
 
-    Notable variables:
-        logfile_name: The filename that the logs from this run should be stored to
-        log_dir: A directory to be used for logging. Existing log files
-        found in will be moved to upload.
+    Args:
+        led_driver: The I2C driver for controlling the LEDs
+        modem: The modem driver
+        force_online: Don't fall back to offline mode if the modem fails to power on
+        require_connection: The mode can't run offline, so give up if the recorder is in offline mode
+
+    Returns:
+        working_dir, upload_dir, data_dir, server_url - or None if require_connection
+        is set and the recorder is in offline mode
     """
 
     global GLOB_no_sd_mode
@@ -579,6 +883,11 @@ def record_default_waraki(led_driver, modem):
         # Enable the modem for a mobile network connection. If no modem set recorder to offline mode
         GLOB_offline_mode = not modem.power_on()
 
+    if force_online:
+        GLOB_offline_mode = False
+
+    tune_writeback()
+
     # Try to mount the external SD card
     try:
         mount_ext_sd(SD_MNT_LOC)
@@ -608,6 +917,9 @@ def record_default_waraki(led_driver, modem):
     if GLOB_offline_mode:
         # Set LEDs to offline mode
         set_led(led_driver, DATA_LED_CHS, DATA_LED_NO_CONN_OFFL)
+        if require_connection:
+            logger.error('No internet connection: this mode requires a connection')
+            return None
         logger.info('Recorder is in offline mode saving to SD card')
     else:
         # Waiting for internet connection
@@ -627,14 +939,28 @@ def record_default_waraki(led_driver, modem):
     log.move_archived_to_dir(upload_dir)
 
     # Get the server URL from the config file
-    with open(CONFIG_FNAME) as cfgf:
-        server_url = json.load(cfgf)["device"]["server_url"]
+    server_url = get_config()["device"]["server_url"]
+
+    return working_dir, upload_dir, data_dir, server_url
+
+
+def record_default_waraki(led_driver, modem):
+    """
+    Function to setup, run and log continuous sampling from the sensor.
+
+    Notable variables:
+        logfile_name: The filename that the logs from this run should be stored to
+        log_dir: A directory to be used for logging. Existing log files
+        found in will be moved to upload.
+    """
+
+    working_dir, upload_dir, data_dir, server_url = setup_recording(led_driver, modem)
 
     # Now get the sensor
     sensor = auto_configure_sensor()
 
     # Set up the threads to run and an event handler to allow them to be shutdown cleanly
-    die = threading.Event()
+    die = GLOB_die
     signal.signal(signal.SIGINT, exit_handler)
 
     if not GLOB_offline_mode:
@@ -649,32 +975,27 @@ def record_default_waraki(led_driver, modem):
     # Initialise background thread to do remote sync of the root upload directory
     # Failure here does not preclude data capture and might be temporary so log
     # errors but don't exit.
-    try:
-        # start the recorder
-        logger.info('Starting continuous recording at {}'.format(dt.datetime.utcnow()))
-        record_thread.start()
+    # start the recorder
+    logger.info('Starting continuous recording at {}'.format(dt.datetime.utcnow()))
+    record_thread.start()
 
-        if GLOB_offline_mode:
-            logger.info('Running in offline mode - no GCS synchronisation')
-        else:
-            # start the GCS sync thread
-            sync_thread.start()
-            logger.info('Starting Waraki server sync every {} seconds at {}'.format(sensor.server_sync_interval, dt.datetime.utcnow()))
-
-        # now run a loop that will continue with a small grain until
-        # an interrupt arrives, this is necessary to keep the program live
-        # and listening for interrupts
-        while True:
-            time.sleep(1)
-    except StopMonitoring:
-        # We've had an interrupt signal, so tell the threads to shutdown,
-        # wait for them to finish and then exit the program
-        die.set()
-        record_thread.join()
-        if not GLOB_offline_mode:
-            sync_thread.join()
+    if GLOB_offline_mode:
+        logger.info('Running in offline mode - no GCS synchronisation')
+    else:
+        # start the GCS sync thread
+        sync_thread.start()
+        logger.info('Starting Waraki server sync every {} seconds at {}'.format(sensor.server_sync_interval, dt.datetime.utcnow()))
+
+    # Block until the SIGINT handler sets die, this is necessary to keep the
+    # program live and listening for interrupts
+    die.wait()
+    # We've had an interrupt signal, so wait for the threads to finish
+    # and then exit the program
+    record_thread.join()
+    if not GLOB_offline_mode:
+        sync_thread.join()
 
-        logger.info('Recording and sync shutdown, exiting at {}'.format(dt.datetime.utcnow()))
+    logger.info('Recording and sync shutdown, exiting at {}'.format(dt.datetime.utcnow()))
 
     
 
@@ -690,72 +1011,14 @@ def record_http(led_driver, modem):
         found in will be moved to upload.
     """
 
-    global GLOB_no_sd_mode
-    global GLOB_is_connected
-    global GLOB_offline_mode
-    global log
-
-    if not GLOB_offline_mode:
-        # Enable the modem for a mobile network connection. If no modem set recorder to offline mode
-        GLOB_offline_mode = not modem.power_on()
-    
     #just hardcoding the mode for now; we don't need to concern ourselves with the offline mode feature.
-    GLOB_offline_mode = False
+    working_dir, upload_dir, data_dir, server_url = setup_recording(led_driver, modem, force_online=True)
 
-    # Try to mount the external SD card
-    try:
-        mount_ext_sd(SD_MNT_LOC)
-        check_sd_not_corrupt(SD_MNT_LOC)
-    except Exception as e:
-        GLOB_no_sd_mode = True
-        logger.info('Couldn\'t mount external SD c {}'.format(str(e)))
-
-    # Try to load the config files from the SD card
-    try:
-        copy_sd_card_config(SD_MNT_LOC, CONFIG_FNAME)
-    except Exception as e:
-        # Check if there's a local config file we can fall back to
-        if os.path.exists(CONFIG_FNAME):
-            logger.info('Couldn\'t copy SD card config, but a config file already exists so continuing ({})'.format(str(e)))
-        else:
-            logger.info('Couldn\'t copy SD card config, and no config already exists... ({})'.format(str(e)))
-
-            if GLOB_no_sd_mode:
-                # If there's no SD card too then there's no point in continuing
-                logger.info('GLOB_no_sd_mode also activated - can\'t fallback as offline recorder so bailing')
-                raise e
-            else:
-                # If there is an SD card we can just run as an offline recorder saving to the SD
-                GLOB_offline_mode = True
-
-    if GLOB_offline_mode:
-        # Set LEDs to offline mode
-        set_led(led_driver, DATA_LED_CHS, DATA_LED_NO_CONN_OFFL)
-        logger.info('Recorder is in offline mode saving to SD card')
-    else:
-        # Waiting for internet connection
-        GLOB_is_connected = wait_for_internet_conn(BOOT_INTERNET_RETRIES, led_driver, DATA_LED_CHS, col_succ=DATA_LED_CONN, col_fail=DATA_LED_NO_CONN)
-
-        if GLOB_is_connected:
-            # Update time from internet
-            update_time()
-
-    # Determine the system configuration options automatically
-    working_dir, upload_dir, data_dir = auto_sys_config(SD_MNT_LOC, not GLOB_no_sd_mode)
-
-    # Clean data directories
-    clean_dirs(working_dir,upload_dir,data_dir)
-
-    # Move archived logs to the upload directory
-    log.move_archived_to_dir(upload_dir)
-
-    with open(CONFIG_FNAME) as cfgf:
-        server_url = json.load(cfgf)["device"]["server_url"]
     # Now get the sensor
     sensor = auto_configure_sensor()
 
     # Set up the threads to run and an event handler to allow them to be shutdown cleanly
-    die = threading.Event()
+    die = GLOB_die
     signal.signal(signal.SIGINT, exit_handler)
 
     if not GLOB_offline_mode:
@@ -769,79 +1032,32 @@ def record_http(led_driver, modem):
     # Initialise background thread to do remote sync of the root upload directory
     # Failure here does not preclude data capture and might be temporary so log
     # errors but don't exit.
-    try:
-        # start the recorder
-        logger.info('Starting continuous recording at {}'.format(dt.datetime.utcnow()))
-        record_thread.start()
-
-        if GLOB_offline_mode:
-            logger.info('Running in offline mode - no GCS synchronisation')
-        else:
-            # start the GCS sync thread
-            sync_thread.start()
-            logger.info('Starting GCS server sync every {} seconds at {}'.format(sensor.server_sync_interval, dt.datetime.utcnow()))
-
-        # now run a loop that will continue with a small grain until
-        # an interrupt arrives, this is necessary to keep the program live
-        # and listening for interrupts
-        while True:
-            time.sleep(1)
-    except StopMonitoring:
-        # We've had an interrupt signal, so tell the threads to shutdown,
-        # wait for them to finish and then exit the program
-        die.set()
-        record_thread.join()
-        if not GLOB_offline_mode:
-            sync_thread.join()
-
-        logger.info('Recording and sync shutdown, exiting at {}'.format(dt.datetime.utcnow()))
-
-
-def record_websocket_safe(led_driver, modem):
-    global GLOB_no_sd_mode
-    global GLOB_is_connected
-    global GLOB_offline_mode
-    global log
-
-    if not GLOB_offline_mode:
-        GLOB_offline_mode = not modem.power_on()
-
-    try:
-        mount_ext_sd(SD_MNT_LOC)
-        check_sd_not_corrupt(SD_MNT_LOC)
-    except Exception as e:
-        GLOB_no_sd_mode = True
-        logger.info('Couldn\'t mount external SD card: {}'.format(str(e)))
-
-    try:
-        copy_sd_card_config(SD_MNT_LOC, CONFIG_FNAME)
-    except Exception as e:
-        if os.path.exists(CONFIG_FNAME):
-            logger.info('Couldn\'t copy SD card config, but a config file already exists so continuing ({})'.format(str(e)))
-        else:
-            logger.info('Couldn\'t copy SD card config, and no config already exists... ({})'.format(str(e)))
-
-            if GLOB_no_sd_mode:
-                logger.info('GLOB_no_sd_mode also activated - can\'t fallback as offline recorder so bailing')
-                raise e
-            else:
-                GLOB_offline_mode = True
+    # start the recorder
+    logger.info('Starting continuous recording at {}'.format(dt.datetime.utcnow()))
+    record_thread.start()
 
     if GLOB_offline_mode:
-        set_led(led_driver, DATA_LED_CHS, DATA_LED_NO_CONN_OFFL)
-        logger.info('Recorder is in offline mode saving to SD card')
+        logger.info('Running in offline mode - no GCS synchronisation')
     else:
-        GLOB_is_connected = wait_for_internet_conn(BOOT_INTERNET_RETRIES, led_driver, DATA_LED_CHS, col_succ=DATA_LED_CONN, col_fail=DATA_LED_NO_CONN)
+        # start the GCS sync thread
+        sync_thread.start()
+        logger.info('Starting GCS server sync every {} seconds at {}'.format(sensor.server_sync_interval, dt.datetime.utcnow()))
+
+    # Block until the SIGINT handler sets die, this is necessary to keep the
+    # program live and listening for interrupts
+    die.wait()
+    # We've had an interrupt signal, so wait for the threads to finish
+    # and then exit the program
+    record_thread.join()
+    if not GLOB_offline_mode:
+        sync_thread.join()
 
-        if GLOB_is_connected:
-            update_time()
+    logger.info('Recording and sync shutdown, exiting at {}'.format(dt.datetime.utcnow()))
 
-    working_dir, upload_dir, data_dir = auto_sys_config(SD_MNT_LOC, not GLOB_no_sd_mode)
-    clean_dirs(working_dir, upload_dir, data_dir)
-    log.move_archived_to_dir(upload_dir)
 
-    with open(CONFIG_FNAME) as cfgf:
-        server_url = json.load(cfgf)["device"]["server_url"]
+def record_websocket_safe(led_driver, modem):
+    working_dir, upload_dir, data_dir, server_url = setup_recording(led_driver, modem)
+
     ws_uri = server_url.replace("http://", "ws://").replace("https://", "wss://") + "/ws/audio/"
     logger.info(f"ws uri is {ws_uri}")
     file_queue = queue.Queue(maxsize=20)
@@ -854,13 +1070,13 @@ def record_websocket_safe(led_driver, modem):
         ext = ".mp3" if sensor.compress_data else ".wav"
         full_path = os.path.join(data_dir, out_name + ext)
         if os.path.exists(full_path):
-            logger.info(f"[ENQ] {full_path}")
+            logger.info("[ENQ] %s", full_path)
             file_queue.put(full_path)
         return out_name
 
     sensor.postprocess = patched_post
 
-    die = threading.Event()
+    die = GLOB_die
     signal.signal(signal.SIGINT, exit_handler)
 
     if not GLOB_offline_mode:
@@ -869,80 +1085,35 @@ def record_websocket_safe(led_driver, modem):
     record_thread = threading.Thread(target=continuous_recording, args=(sensor, working_dir,
                                                                     data_dir, led_driver, die))
 
-    try:
-        # start the recorder
-        logger.info('Starting continuous recording at {}'.format(dt.datetime.utcnow()))
-        record_thread.start()
-
-        if GLOB_offline_mode:
-            logger.info('Running in offline mode - no Websocket upload')
-        else:
-            ws_thread.start()
-            logger.info('Starting Websocket upload every {} seconds at {}'.format(sensor.server_sync_interval, dt.datetime.utcnow()))
-
-        while True:
-            time.sleep(1)
-    except StopMonitoring:
-        die.set()
-        record_thread.join()
-        if not GLOB_offline_mode:
-            ws_thread.join()
-
-        logger.info('Recording and sync shutdown, exiting at {}'.format(dt.datetime.utcnow()))
-
+    # start the recorder
+    logger.info('Starting continuous recording at {}'.format(dt.datetime.utcnow()))
+    record_thread.start()
 
-def record_continuous_stream(led_driver, modem):
-    global GLOB_no_sd_mode
-    global GLOB_is_connected
-    global GLOB_offline_mode
-    global log
+    if GLOB_offline_mode:
+        logger.info('Running in offline mode - no Websocket upload')
+    else:
+        ws_thread.start()
+        logger.info('Starting Websocket upload every {} seconds at {}'.format(sensor.server_sync_interval, dt.datetime.utcnow()))
 
+    die.wait()
+    record_thread.join()
     if not GLOB_offline_mode:
-        GLOB_offline_mode = not modem.power_on()
+        ws_thread.join()
 
-    try:
-        mount_ext_sd(SD_MNT_LOC)
-        check_sd_not_corrupt(SD_MNT_LOC)
-    except Exception as e:
-        GLOB_no_sd_mode = True
-        logger.info('Couldn\'t mount external SD card: {}'.format(str(e)))
+    logger.info('Recording and sync shutdown, exiting at {}'.format(dt.datetime.utcnow()))
 
-    try:
-        copy_sd_card_config(SD_MNT_LOC, CONFIG_FNAME)
-    except Exception as e:
-        if os.path.exists(CONFIG_FNAME):
-            logger.info('Couldn\'t copy SD card config, but a config file already exists so continuing ({})'.format(str(e)))
-        else:
-            logger.info('Couldn\'t copy SD card config, and no config already exists... ({})'.format(str(e)))
 
-            if GLOB_no_sd_mode:
-                logger.info('GLOB_no_sd_mode also activated - can\'t fallback as oe recorder so bailing')
-                raise e
-            else:
-                GLOB_offline_mode = True
-
-    if GLOB_offline_mode:
-        set_led(led_driver, DATA_LED_CHS, DATA_LED_NO_CONN_OFFL)
-        logger.error('No internet connection: this mode requires a connection')
+def record_continuous_stream(led_driver, modem):
+    setup = setup_recording(led_driver, modem, require_connection=True)
+    if setup is None:
         return
-    else:
-        GLOB_is_connected = wait_for_internet_conn(BOOT_INTERNET_RETRIES, led_driver, DATA_LED_CHS, col_succ=DATA_LED_CONN, col_fail=DATA_LED_NO_CONN)
+    working_dir, upload_dir, data_dir, srv = setup
 
-        if GLOB_is_connected:
-            update_time()
-
-
-    working_dir, upload_dir, data_dir = auto_sys_config(SD_MNT_LOC, not GLOB_no_sd_mode)
-    clean_dirs(working_dir, upload_dir, data_dir)
-    log.move_archived_to_dir(upload_dir)
-
-    with open(CONFIG_FNAME) as f:
-        srv = json.load(f)['device']['server_url']
     ws_uri = srv.replace("http://","ws://").replace("https://","wss://") + "/ws/audio/"
 
-    raw_q   = queue.Queue(maxsize=50)
-    ready_q = queue.Queue(maxsize=50)
-    die     = threading.Event()
+    raw_q   = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    ready_q = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+    die     = GLOB_die
     signal.signal(signal.SIGINT, exit_handler)
 
     sensor = auto_configure_sensor()
@@ -958,20 +1129,16 @@ def record_continuous_stream(led_driver, modem):
 
     ws_t = threading.Thread(target=ws_uploader_continuous, args=(ws_uri, ready_q, led_driver, DATA_LED_CHS, die))
 
-    try:
-        logger.info('Starting continuous recording at {}'.format(dt.datetime.utcnow()))
-        rec_t.start()
-        compress_t.start()
-        ws_t.start()
+    logger.info('Starting continuous recording at {}'.format(dt.datetime.utcnow()))
+    rec_t.start()
+    compress_t.start()
+    ws_t.start()
 
-        while True:
-            time.sleep(1)
-    except StopMonitoring:
-        die.set()
-        rec_t.join()
-        compress_t.join()
-        ws_t.join()
-        logger.info('Recording and sync shutdown, exiting at {}'.format(dt.datetime.utcnow()))
+    die.wait()
+    rec_t.join()
+    compress_t.join()
+    ws_t.join()
+    logger.info('Recording and sync shutdown, exiting at {}'.format(dt.datetime.utcnow()))
 
 
 
@@ -982,7 +1149,7 @@ def handle_args():
                         help='Run factory test, even if trigger file is not present.')
     parser.add_argument('--force-factory-test-bare', action='store_true',
                         help='Run factory test in bare-board mode, even if trigger file is not present.')
-    parser.add_argument('--version', action='version', version=metadata.version('buggd'))
+    parser.add_argument('--version', action='version', version=BUGGD_VERSION)
     args = parser.parse_args()
     return args
 
@@ -1003,7 +1170,7 @@ def main():
     args = handle_args()
 
     start_time = time.strftime('%Y%m%d_%H%M')
-    logger.info('Start of buggd version %s at %s', metadata.version('buggd'), format(start_time))
+    logger.info('Start of buggd version %s at %s', BUGGD_VERSION, format(start_time))
 
     global leds
     atexit.register(cleanup)
@@ -1039,14 +1206,13 @@ def main():
     leds.all_off()
     
     # TODO: replace this old way of handling the LED's with the new LED driver
-    # Initialise LED driver and turn all channels off
-    led_driver = PCF8574(PCF8574_I2C_BUS, PCF8574_I2C_ADD)
+    # Share the LED driver's PCF8574 rather than opening a second one
+    led_driver = leds.driver.io_expander
     modem = Modem()
 
     # Initialise the LED o
     # mode = config.get("mode")  # e.g., from a JSON file or environment variable
-    with open(CONFIG_FNAME) as f:
-        config = json.load(f)
+    config = get_config()
     mode = config['device'].get('mode', MODE_DEFAULT_WARAKI)  # Load device mode from config
     logger.info(f"Mode selected: {mode}")
     led = UserLED()
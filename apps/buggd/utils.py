@@ -2,7 +2,10 @@
 TODO: This is a dumping ground for a lot of random stuff
 """
 import subprocess
+import re
 import os
+import errno
+import functools
 import logging
 import shutil
 import filecmp
@@ -26,8 +29,48 @@ def set_led(led_driver, channels_arr, col_arr):
         col_arr: The target values for the LED channels (tuple)
     """
 
+    set_leds_multi(led_driver, (channels_arr, col_arr))
+
+
+def set_leds_multi(led_driver, *chs_col_pairs):
+    """
+    Sets the colours of several LEDs on the PCF8574 with a single write
+
+    Args:
+        led_driver: The I2C driver for the PCF8574 chip
+        chs_col_pairs: (channels_arr, col_arr) tuples, as passed to set_led()
+    """
+
+    # Read-modify-write the whole port in one I2C transaction each way, rather
+    # than one read and one write per channel
+    clear_mask = 0
+    set_mask = 0
+    for channels_arr, col_arr in chs_col_pairs:
+        pair_clear, pair_set = _led_masks(tuple(channels_arr), tuple(col_arr))
+        clear_mask |= pair_clear
+        set_mask = (set_mask & ~pair_clear) | pair_set
+
+    state = led_driver.bus.read_byte(led_driver.address)
+    led_driver.bus.write_byte(led_driver.address, (state & ~clear_mask & 0xFF) | set_mask)
+
+
+@functools.lru_cache(maxsize=None)
+def _led_masks(channels_arr, col_arr):
+    """
+    Fold a (channels, colours) pair into the PCF8574 bit masks it touches. The
+    LEDs are active low and the driver maps channel n to bit 7-n. Only a handful
+    of colour constants are ever used so these are computed once and cached.
+    """
+
+    clear_mask = 0
+    set_mask = 0
     for ch, col in zip(channels_arr, col_arr):
-        led_driver.port[ch] = not col
+        bit = 1 << (7 - ch)
+        clear_mask |= bit
+        if not col:
+            set_mask |= bit
+
+    return clear_mask, set_mask
 
 
 def set_led_PCA9685(led_driver, channels_arr, col_arr):
@@ -234,6 +277,27 @@ def copy_sd_card_config(sd_mount_loc, config_fname):
         logger.info('Couldn\'t add network manager profile from config file: {}'.format(str(e)))
 
 
+# Kernel writeback settings for the recording workload. Small dirty limits keep
+# the page cache flushing to the SD card in small steady writes instead of large
+# bursts that stall reads of the upload directory
+WRITEBACK_SYSCTLS = {
+    'vm.dirty_ratio': 2,
+    'vm.dirty_background_ratio': 1,
+    'vm.dirty_expire_centisecs': 500,
+    'vm.dirty_writeback_centisecs': 100,
+}
+
+
+def tune_writeback():
+
+    """
+    Apply WRITEBACK_SYSCTLS to the running kernel
+    """
+
+    args = ' '.join('{}={}'.format(k, v) for k, v in WRITEBACK_SYSCTLS.items())
+    call_cmd_line('sudo sysctl -q -w {}'.format(args))
+
+
 def mount_ext_sd(sd_mount_loc, dev_file_str='mmcblk1p'):
 
     """
@@ -256,7 +320,7 @@ def mount_ext_sd(sd_mount_loc, dev_file_str='mmcblk1p'):
     for dev_f in potential_dev_fs:
         # Try to mount each partition in turn
         logger.info('Trying to mount device {} to {}'.format(dev_f, sd_mount_loc))
-        call_cmd_line('sudo mount -orw /dev/{} {}'.format(dev_f, sd_mount_loc))
+        call_cmd_line('sudo mount -orw,noatime /dev/{} {}'.format(dev_f, sd_mount_loc))
 
         # Check if device mounted successfully
         if os.path.ismount(sd_mount_loc):
@@ -296,6 +360,51 @@ def check_sd_not_corrupt(sd_mnt_dir):
     return True
 
 
+def partial_path(path):
+
+    """
+    Return the name to write path under until it is complete. It's in the same
+    directory, so it can be renamed into place, and starts with '.' so the
+    uploader skips it
+    """
+
+    head, tail = os.path.split(path)
+    return os.path.join(head, '.' + tail)
+
+
+# Names of files left by partial_path() writers: a partial mp3 or WAV, or encode_mp3's
+# segments and concat list
+PARTIAL_FILE_RE = re.compile(r'\..+\.(mp3|wav)(\.part\d+\.mp3|\.parts\.txt)?')
+
+
+def is_partial_file(name):
+
+    """
+    Check whether a file name is one written under partial_path(), or one of the
+    temporary files that go with it
+    """
+
+    return PARTIAL_FILE_RE.fullmatch(name) is not None
+
+
+def publish_file(src, dst):
+
+    """
+    Move a finished file to dst so that dst never exists partly written. Within a
+    filesystem this is one rename. Across filesystems the file is copied under
+    partial_path(dst) first and then renamed into place
+    """
+
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        tmp = partial_path(dst)
+        shutil.move(src, tmp)
+        os.replace(tmp, dst)
+
+
 def merge_dirs(root_src_dir, root_dst_dir, delete_src=True):
 
     """
@@ -316,26 +425,42 @@ def merge_dirs(root_src_dir, root_dst_dir, delete_src=True):
     if delete_src:
         shutil.rmtree(root_src_dir, ignore_errors=True)
 
-def discover_serial():
+@functools.lru_cache(maxsize=1)
+def read_cpu_serial():
 
     """
-    Function to return the Raspberry Pi serial from /proc/cpuinfo
+    Read the Raspberry Pi serial from /proc/cpuinfo. The serial can't change, so it is
+    cached after the first successful read. A failed read raises, and lru_cache doesn't
+    cache exceptions, so the next call tries again.
 
     Returns:
-        A string containing the serial number or an error placeholder
+        A string containing the serial number
     """
 
-    # parse /proc/cpuinfo
-    cpu_serial = None
-    try:
-        f = open('/proc/cpuinfo', 'r')
+    with open('/proc/cpuinfo', 'r') as f:
+        cpu_serial = None
         for line in f:
             if line[0:6] == 'Serial':
                 cpu_serial = line.split(':')[1].strip()
-        f.close()
-        # No serial line found?
-        if cpu_serial is None:
-            raise IOError
+
+    # No serial line found?
+    if cpu_serial is None:
+        raise IOError('No serial in /proc/cpuinfo')
+
+    return cpu_serial
+
+
+def discover_serial():
+
+    """
+    Function to return the Raspberry Pi serial from /proc/cpuinfo.
+
+    Returns:
+        A string containing the serial number or an error placeholder
+    """
+
+    try:
+        cpu_serial = read_cpu_serial()
     except IOError:
         cpu_serial = "ERROR000000001"
 
@@ -390,6 +515,14 @@ def clean_dirs(working_dir, upload_dir, data_dir):
         shutil.rmtree(working_dir, ignore_errors=True)
 
     if os.path.exists(upload_dir):
+        # Remove partial files left by a crash or power cut part way through writing a recording.
+        # The uploader skips them and their source was in the working directory, so nothing else would
+        for subdir, dirs, files in os.walk(upload_dir):
+            for file_ in files:
+                if is_partial_file(file_):
+                    logger.info('Removing partial file: {}'.format(os.path.join(subdir, file_)))
+                    os.remove(os.path.join(subdir, file_))
+
         # Remove empty directories in the upload directory, from bottom up
         for subdir, dirs, files in os.walk(upload_dir, topdown=False):
             if not os.listdir(subdir):
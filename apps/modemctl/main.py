@@ -7,7 +7,6 @@ It's mainly intended for use during debugging.
 import logging
 import sys
 import argparse
-from ...drivers.modem import Modem, ModemInUseException
 
 def handle_power_command(logger, modem, args):
     """ Turn the modem on / off """
@@ -104,6 +103,8 @@ def main():
 
     # Execute the function associated with the chosen command
     if hasattr(args, 'func'):
+        # Import the driver here so --help and usage errors don't load the hardware modules
+        from ...drivers.modem import Modem, ModemInUseException
         modem = Modem()
         try:
             args.func(logger, modem, args)
@@ -1,7 +1,6 @@
 import argparse
 import logging
 import sys
-from buggd.drivers.soundcard import Soundcard
 
 def handle_power_command(logger, soundcard, args):
     """ Set power state of either the internal or external mic interface """
@@ -67,8 +66,6 @@ def main():
     parser = argparse.ArgumentParser(description='Test sound commands.')
     subparsers = parser.add_subparsers(dest='command', help='Commands')
 
-    soundcard = Soundcard()
-
     # Power command
     power_parser = subparsers.add_parser('power', help='Control power state')
     power_subparsers = power_parser.add_subparsers(required=True, dest='channel', help='Specify channel to control') 
@@ -105,6 +102,10 @@ def main():
     else:
         # Execute the function associated with the chosen command
         if hasattr(args, 'func'):
+            # Only import the driver, take the soundcard lock and set up the hardware
+            # once we know there's a command to run
+            from buggd.drivers.soundcard import Soundcard
+            soundcard = Soundcard()
             args.func(logger, soundcard, args)
         else:
             parser.print_help()
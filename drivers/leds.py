@@ -1,3 +1,4 @@
+import functools
 from enum import Enum, auto
 from pcf8574 import PCF8574
 
@@ -45,6 +46,21 @@ class Driver():
         except AssertionError:
             pass
 
+    def set_mask(self, mask, values):
+        """
+        Sets every channel whose bit is in mask to the matching bit of values,
+        with one read and one write of the port instead of one of each per channel.
+        Bits are in port order (channel n is bit 7-n) and already active low.
+        """
+        state = self.io_expander.bus.read_byte(self.address)
+        self.io_expander.bus.write_byte(self.address, (state & ~mask & 0xFF) | (values & mask))
+
+
+@functools.lru_cache(maxsize=None)
+def get_driver(bus=BUS, address=ADDRESS):
+    """ Returns the one Driver for the IO expander at (bus, address), creating it on first use """
+    return Driver(bus, address)
+
 
 class LED:
     """ This class represents an RGB LED """
@@ -57,31 +73,48 @@ class LED:
         }
         self.stay_on_at_exit = False
 
+        # Channels stuck in hardware, and the port bits for each colour that can still be displayed
+        self.hw_fixed = [(index, name, channel) for index, (name, channel) in enumerate(self.channels.items())
+                         if isinstance(channel, bool)]
+        self.colour_bits = {colour: self.port_bits(col) for colour, col in COLOUR_THEORY.items()
+                            if all(col[index] == channel for index, _, channel in self.hw_fixed)}
+
     def set(self, colour: Colour):
         """
         Sets the colour of the LED
         An LED, like the Power LED, can have a colour hard-wired to a specific channel, so 
-        check for that and raise an error if we try to set a colour that can't be displayed
+        raise an error if we try to set a colour that can't be displayed
         """
-        col = COLOUR_THEORY[colour]
-        r, g, b = col
+        bits = self.colour_bits.get(colour)
+        if bits is None:
+            col = COLOUR_THEORY[colour]
+            for index, name, channel in self.hw_fixed:
+                if col[index] != channel:
+                    raise ValueError(f"{colour} cannot be displayed on this LED because \
+                                     it's colour {name} is hard-wired to {channel}")
 
-        # Check if any of the channels are stuck in hardware
-        for index, element in enumerate(self.channels.items()):
-            if isinstance(element[1], bool):
-                if not element[1] == col[index]:
-                    inv_map = {v: k for k, v in COLOUR_THEORY.items()}
-                    raise ValueError(f"{inv_map.get(col)} cannot be displayed on this LED because \
-                                     it's colour {element[0]} is hard-wired to {element[1]}")
+        self.driver.set_mask(*bits)
 
-        self.driver.set(self.channels['red'], r)
-        self.driver.set(self.channels['green'], g)
-        self.driver.set(self.channels['blue'], b)
+    def port_bits(self, col):
+        """
+        Returns the (mask, values) port bits that display the RGB tuple col,
+        skipping any channel that is hard-wired
+        """
+        mask = 0
+        values = 0
+        for channel, value in zip(self.channels.values(), col):
+            if isinstance(channel, bool):
+                continue
+            bit = 1 << (7 - channel)
+            mask |= bit
+            if not value:
+                values |= bit
+        return mask, values
 
 class LEDs():
     """ This class contains the three user-facing LEDs on the product """
     def __init__(self):
-        self.driver = Driver(BUS, ADDRESS)
+        self.driver = get_driver(BUS, ADDRESS)
 
         self.top = LED(self.driver, 7, 6, 5)
         self.middle = LED(self.driver, 4, 3, 2)
@@ -92,9 +125,13 @@ class LEDs():
 
     def all_off(self):
         """ Turns off all LEDs """
-        self.top.set(Colour.OFF)
-        self.middle.set(Colour.OFF)
-        self.bottom.set(Colour.RED)
+        mask = 0
+        values = 0
+        for led, colour in ((self.top, Colour.OFF), (self.middle, Colour.OFF), (self.bottom, Colour.RED)):
+            led_mask, led_values = led.colour_bits[colour]
+            mask |= led_mask
+            values |= led_values
+        self.driver.set_mask(mask, values)
 
 
     def at_exit(self):
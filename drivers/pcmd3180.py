@@ -2,7 +2,7 @@
 
 import logging
 import time
-from smbus2 import SMBus
+from smbus2 import SMBus, i2c_msg
 import RPi.GPIO as GPIO
 
 logger = logging.getLogger(__name__)
@@ -11,6 +11,11 @@ SHDNZ = 0
 
 I2C_ADDRESS = 0x4c
 
+# Settle times after changing SHDNZ. The datasheet needs 1ms after releasing
+# SHDNZ before the first I2C transaction; both include some margin.
+POWER_ON_DELAY_S = 0.002
+POWER_OFF_DELAY_S = 0.001
+
 class PCMD3180:
     """
     Class to control the PCMD3180 I2S-to-PDM bridge
@@ -20,26 +25,29 @@ class PCMD3180:
 
     def __init__(self):
         self.address = I2C_ADDRESS
+        # One bus handle for all register access, closed in close()
+        self.i2c = SMBus(1)
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False)
+        # Set the direction once here, powering on/off only changes the output level
+        GPIO.setup(SHDNZ, GPIO.OUT)
 
     def close(self):
-        """ Clean up the GPIO """
-        GPIO.cleanup()
+        """ Close the I2C bus and clean up the GPIO. Only release our own pin so other drivers are left alone """
+        self.i2c.close()
+        GPIO.cleanup(SHDNZ)
 
     def power_on(self):
         """ Turn on the PCMD3180 """
         logger.debug("Powering on PCMD3180")
-        GPIO.setup(SHDNZ, GPIO.OUT)
         GPIO.output(SHDNZ, GPIO.HIGH)
-        time.sleep(0.5)
+        time.sleep(POWER_ON_DELAY_S)
 
     def power_off(self):
         """ Turn off the PCMD3180"""
         logger.debug("Powering off PCMD3180")
-        GPIO.setup(SHDNZ, GPIO.OUT)
         GPIO.output(SHDNZ, GPIO.LOW)
-        time.sleep(0.1)
+        time.sleep(POWER_OFF_DELAY_S)
 
     def reset(self):
         """ Reset the PCMD3180 """
@@ -48,22 +56,18 @@ class PCMD3180:
 
     def write_register(self, reg, data):
         """ Write data to a register over I2C """
-        i2c = SMBus(1)
         try:
-            i2c.write_byte_data(self.address, reg, data)
+            self.i2c.write_byte_data(self.address, reg, data)
         except Exception as e:
             logger.error("Failed to write to register %s: %s", reg, e)
-        i2c.close()
 
     def read_register(self, reg):
         """ Read data from a register over I2C """
-        i2c = SMBus(1)
         try:
-            data = i2c.read_byte_data(self.address, reg)
+            data = self.i2c.read_byte_data(self.address, reg)
         except Exception as e:
             logger.error("Failed to read from register %s: %s", reg, e)
             data = None
-        i2c.close()
         return data
 
     def send_configuration(self):
@@ -91,6 +95,26 @@ class PCMD3180:
             0x3e: 0xff, # Max volume (27dB)
             0x07: 0x80, # LJ format, 16 bit
         }
-        for reg, data in config_data.items():
-            self.write_register(reg, data)
+        # Wake the device first, it needs 1ms before any other register is written
+        self.write_register(0x02, config_data.pop(0x02))
+        time.sleep(0.001)
+
+        # Write each run of consecutive registers as one block, using the
+        # device's register auto-increment
+        for run in contiguous_runs(config_data):
+            try:
+                self.i2c.i2c_rdwr(i2c_msg.write(self.address, [run[0][0]] + [data for _, data in run]))
+            except Exception as e:
+                logger.error("Failed to write to registers from %s: %s", run[0][0], e)
         logger.info("Configuration sent.")
+
+
+def contiguous_runs(registers):
+    """ Split a {register: data} dict into lists of (register, data) with consecutive addresses """
+    runs = []
+    for reg, data in sorted(registers.items()):
+        if runs and runs[-1][-1][0] == reg - 1:
+            runs[-1].append((reg, data))
+        else:
+            runs.append([(reg, data)])
+    return runs
@@ -4,11 +4,20 @@ import RPi.GPIO as GPIO
 import spidev
 import logging
 import os
+import sys
 import json
+import array
+import operator
 import subprocess
 from .lock import Lock
 from .pcmd3180 import PCMD3180
 
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional, the pure-Python statistics below are used without it
+    np = None
+
 logger = logging.getLogger(__name__)
 
 EXT_MIC_EN = 12
@@ -37,6 +46,9 @@ class Soundcard:
     P3V3 = "P3V3"   # 3.3V on M12 pin 4
     P48 = "P48"     # 48V
 
+    # PGA register bits for each phantom power mode
+    PHANTOM_BITS = {NONE: 0, PIP: 1, P3V3: 2, P48: 4}
+
     def __init__(self, lock_file_path=LOCK_FILE):
         """ Attempt to acquire the lock and initialise the GPIO """
         try:
@@ -49,6 +61,8 @@ class Soundcard:
         self.pcmd3180 = PCMD3180()
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False) # Squash warning if the pin is already in use
+        # Set the direction once here, enabling/disabling only changes the output level
+        GPIO.setup(EXT_MIC_EN, GPIO.OUT)
         self.spi = spidev.SpiDev()
         self.spi.open(0, 0)
         self.spi.max_speed_hz = 5_000_000
@@ -59,6 +73,8 @@ class Soundcard:
         self.phantom_mode = 0
 
         self.state={'gain':0, 'phantom':0}
+        # The state as it is in STATE_FILE, so unchanged state isn't rewritten
+        self.stored_state = None
         self.load_state()
 
     def close(self):
@@ -66,14 +82,23 @@ class Soundcard:
         logger.debug("Closing soundcard")
         self.disable_external_channel()
         self.disable_internal_channel()
-        GPIO.cleanup()
+        # Only release our own pins so other drivers (e.g. the modem) are left alone
+        self.pcmd3180.close()
+        GPIO.cleanup(EXT_MIC_EN)
         self.spi.close()
         self.lock.release_lock()
 
     def store_state(self):
-        """ Write the hardware state to the temporary file. """
-        with open(STATE_FILE, 'w', encoding="utf-8") as file:
+        """ Write the hardware state to the temporary file, if it has changed. """
+        if self.state == self.stored_state:
+            return
+
+        # Write to a temporary file and rename it, so other processes never see a partial file
+        tmp_file = STATE_FILE + '.tmp'
+        with open(tmp_file, 'w', encoding="utf-8") as file:
             json.dump(self.state, file)
+        os.replace(tmp_file, STATE_FILE)
+        self.stored_state = dict(self.state)
         logger.debug("Soundcard state saved %s", self.state)
 
     def load_state(self):
@@ -82,6 +107,7 @@ class Soundcard:
             with open(STATE_FILE, 'r', encoding="utf-8") as file:
                 try:
                     self.state = json.load(file)
+                    self.stored_state = dict(self.state)
                 except json.JSONDecodeError:
                     logger.warning("Failed to load soundcard state.")
 
@@ -97,17 +123,16 @@ class Soundcard:
         """ Turn on the soundcard power rails, set gain to 0, and disable phantom power """
         logger.debug("Enabling external channel")
 
-        GPIO.setup(EXT_MIC_EN, GPIO.OUT)
         GPIO.output(EXT_MIC_EN, 1)
         self.set_gain(0)
         self.set_phantom(self.NONE)
-        self.write_state()
+        # The PGA has just been powered up, so always send it the state
+        self.write_state(force=True)
 
     def disable_external_channel(self):
         """ Turn off the soundcard power rails"""
         logger.debug("Disabling external channel")
 
-        GPIO.setup(EXT_MIC_EN, GPIO.OUT)
         GPIO.output(EXT_MIC_EN, 0)
 
     def enable_internal_channel(self):
@@ -123,18 +148,21 @@ class Soundcard:
 
         self.pcmd3180.power_off()
 
-    def write_state(self):
-        """ Write the current state to the soundcard """
-        tx = [0, 0]
-        tx[0] |= self.gain
-        tx[1] |= self.zc_gpo << 5
-        tx[1] |= self.zc_gain << 4
-        tx[1] |= self.phantom_mode
+    def write_state(self, force=False):
+        """ Write the current state to the soundcard, unless it's unchanged and force isn't set """
+        state = {'gain':self.gain, 'phantom':self.phantom_mode}
+        if not force and state == self.state:
+            logger.debug("Soundcard state unchanged, not writing")
+            return
+
+        tx = bytes([self.gain,
+                    (self.zc_gpo << 5) | (self.zc_gain << 4) | self.phantom_mode])
 
         logger.debug("Writing state: gain %d, phantom %d", self.gain, self.phantom_mode)
-        self.spi.xfer(tx)
+        # Write only, the PGA has nothing to read back
+        self.spi.writebytes2(tx)
 
-        self.state = {'gain':self.gain, 'phantom':self.phantom_mode}
+        self.state = state
         self.store_state()
 
     def set_gain(self, gain):
@@ -149,17 +177,10 @@ class Soundcard:
     def set_phantom(self, mode):
         """ Set the phantom power mode """
         logger.info("Setting phantom power to %s", mode)
-        match mode:
-            case self.NONE:
-                self.phantom_mode = 0
-            case self.PIP:
-                self.phantom_mode = 1
-            case self.P3V3:
-                self.phantom_mode = 2
-            case self.P48:
-                self.phantom_mode = 4
-            case _:
-                raise ValueError("Invalid phantom mode")
+        try:
+            self.phantom_mode = self.PHANTOM_BITS[mode]
+        except KeyError:
+            raise ValueError("Invalid phantom mode") from None
         self.write_state()
 
         
@@ -171,18 +192,12 @@ class Soundcard:
         Returns a dict with the variance of each channel.
         """
 
-        fn = '/tmp/soundcard_test.raw'
-        fn_internal = fn + '.0'
-        fn_external = fn + '.1'
-
         try:
-            subprocess.run(['arecord', '--separate-channels', '--device', 'plughw:0,0', '--channels=2', '--format=S16_LE', '--rate=48000', '--duration=1', '--file-type=raw', fn], check=True)
-
-            samples_internal = read_16bit_signed_pcm(fn_internal)
-            samples_external = read_16bit_signed_pcm(fn_external)
+            # Read the interleaved samples straight from arecord's stdout rather than via files in /tmp
+            result = subprocess.run(['arecord', '--device', 'plughw:0,0', '--channels=2', '--format=S16_LE', '--rate=48000', '--duration=1', '--file-type=raw', '-'],
+                                    check=True, stdout=subprocess.PIPE)
 
-            variance_internal = calculate_variance(samples_internal, calculate_mean(samples_internal))
-            variance_external = calculate_variance(samples_external, calculate_mean(samples_external))
+            variance_internal, variance_external = calculate_pcm_variances(result.stdout, 2)
             
             return {'internal': variance_internal, 'external': variance_external}
             
@@ -191,20 +206,42 @@ class Soundcard:
             return None
 
 
-def read_16bit_signed_pcm(file_path):
-    """ Read a raw 16-bit signed PCM file and return the samples as a list. """
-    with open(file_path, 'rb') as file:
-        content = file.read()
-        samples = [int.from_bytes(content[i:i+2], 'little', signed=True) for i in range(0, len(content), 2)]
+def calculate_pcm_variances(content, channels):
+    """
+    Calculate the variance of each channel of interleaved raw 16-bit signed PCM,
+    using NumPy if it's available. Returns a list with one variance per channel.
+    """
+    # Drop any partial frame at the end
+    content = content[:len(content) - len(content) % (2 * channels)]
+
+    if np is not None:
+        samples = np.frombuffer(content, dtype='<i2').reshape(-1, channels)
+        return [float(v) for v in samples.var(axis=0, dtype=np.float64)]
+
+    samples = read_16bit_signed_pcm(content)
+    variances = []
+    for ch in range(channels):
+        ch_samples = samples[ch::channels]
+        variances.append(calculate_variance(ch_samples))
+    return variances
+
+
+def read_16bit_signed_pcm(content):
+    """ Convert raw 16-bit signed PCM bytes to an array of samples. """
+    samples = array.array('h')
+    samples.frombytes(content)
+    if sys.byteorder == 'big':
+        samples.byteswap()
     return samples
 
 
-def calculate_mean(data):
-    """ Calculate the mean of a list of numbers. Avoids dependency on numpy. """
-    return sum(data) / len(data)
-
-
-def calculate_variance(data, mean):
-    """ Calculate the variance of a list of numbers. Avoids dependency on numpy."""
-    return sum((x - mean) ** 2 for x in data) / len(data)
+def calculate_variance(data):
+    """
+    Calculate the variance of a sequence of integers. Avoids dependency on numpy.
+    The sums are exact integers computed in C by sum() and map(), so no per-sample bytecode runs.
+    """
+    n = len(data)
+    total = sum(data)
+    total_sq = sum(map(operator.mul, data, data))
+    return (n * total_sq - total * total) / (n * n)
 
@@ -26,5 +26,5 @@ class UserLED():
         GPIO.output(self.pin, GPIO.HIGH)
 
     def close(self):
-        """ Clean up the GPIO """
-        GPIO.cleanup()
\ No newline at end of file
+        """ Clean up the GPIO. Only release our own pin so other drivers are left alone """
+        GPIO.cleanup(self.pin)
\ No newline at end of file
@@ -0,0 +1,356 @@
+import os
+import signal
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from buggd.apps.buggd.utils import call_cmd_line, partial_path
+
+logger = logging.getLogger(__name__)
+
+# ffmpeg audio codec arguments for each supported mp3 encoder. libshine is a
+# fixed-point encoder that is much faster than LAME on the Pi's ARM cores, at a
+# fixed bitrate rather than LAME's VBR. LAME uses V2 VBR, which is transparent, with
+# a faster psychoacoustic search (compression_level 7) than ffmpeg's default of 5
+MP3_ENCODER_ARGS = {
+    'lame': ('-codec:a', 'libmp3lame', '-compression_level', '7', '-qscale:a', '2'),
+    'shine': ('-codec:a', 'libshine', '-b:a', '128k'),
+}
+
+
+def mp3_encoder_args(encoder):
+    """
+    Return the ffmpeg codec arguments for an mp3_encoder config value, as a list
+
+    Args:
+        encoder: 'lame' or 'shine'
+    """
+
+    try:
+        return list(MP3_ENCODER_ARGS[encoder])
+    except KeyError:
+        raise ValueError('Unknown mp3_encoder {}, must be one of {}'.format(encoder, ', '.join(MP3_ENCODER_ARGS))) from None
+
+
+def volume_filter_args(amplification):
+    """
+    Return the ffmpeg filter arguments that amplify the audio as a list, empty if amplification is 1
+    """
+
+    if amplification == 1:
+        return []
+    return ['-filter:a', 'volume={}'.format(amplification)]
+
+
+def encode_mp3(in_path, out_path, codec_args, amplification, channels, duration, workers=1):
+    """
+    Amplify and compress an audio file to mp3 with ffmpeg. With more than one worker
+    the audio is split into that many segments which are encoded in parallel, one
+    ffmpeg per core, and their frames are then joined without re-encoding. This is
+    not seamless: each segment is a separate encode with its own encoder delay,
+    padding and bit reservoir, so every join has a short gap or click of a few tens
+    of milliseconds.
+    If any segment or the join fails, the file is encoded again in a single pass.
+    Everything is written under partial_path() names and the finished file is renamed
+    to out_path, so the uploader never sees a partial mp3.
+
+    Args:
+        in_path: The audio file to compress
+        out_path: Where to write the mp3 file
+        codec_args: ffmpeg codec arguments, from mp3_encoder_args()
+        amplification: Factor to amplify the audio by
+        channels: Number of audio channels
+        duration: Length of the audio in seconds, used to split it into segments
+        workers: How many segments to encode in parallel, at most one per CPU core
+
+    Returns:
+        True if out_path was written, False if ffmpeg failed to encode the file
+    """
+
+    def ffmpeg_argv(seek, part_path):
+        # Segments get no Xing header, which would describe the segment rather than the joined file
+        no_xing = ['-write_xing', '0'] if seek else []
+        return (['ffmpeg', '-loglevel', 'panic'] + seek + ['-i', in_path] + codec_args +
+                volume_filter_args(amplification) + ['-ac', str(channels)] + no_xing + [part_path])
+
+    tmp_path = partial_path(out_path)
+    workers = min(workers, os.cpu_count() or 1)
+    if workers > 1:
+        if encode_mp3_segments(ffmpeg_argv, tmp_path, duration, workers):
+            os.replace(tmp_path, out_path)
+            return True
+        logger.warning('Parallel encode of {} failed, encoding it in a single pass'.format(in_path))
+
+    if not run_ffmpeg(ffmpeg_argv([], tmp_path)) or not file_has_data(tmp_path):
+        remove_if_exists(tmp_path)
+        return False
+    os.replace(tmp_path, out_path)
+    return True
+
+
+def encode_mp3_segments(ffmpeg_argv, tmp_path, duration, workers):
+    """
+    Encode the segments for encode_mp3() in parallel and join them into tmp_path
+
+    Returns:
+        True if every segment and the joined file were written
+    """
+
+    seg_len = duration / workers
+    part_paths = ['{}.part{}.mp3'.format(tmp_path, i) for i in range(workers)]
+    part_cmds = []
+    for i, part_path in enumerate(part_paths):
+        # The last segment runs to the end of the file, however long it really is
+        seek = ['-ss', str(i * seg_len)]
+        if i < workers - 1:
+            seek += ['-t', str(seg_len)]
+        part_cmds.append(ffmpeg_argv(seek, part_path))
+
+    list_path = tmp_path + '.parts.txt'
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parts_ok = all(executor.map(run_ffmpeg, part_cmds))
+
+        if not parts_ok or not all(file_has_data(part_path) for part_path in part_paths):
+            return False
+
+        with open(list_path, 'w') as f:
+            f.writelines("file '{}'\n".format(part_path) for part_path in part_paths)
+        joined = run_ffmpeg(['ffmpeg', '-loglevel', 'panic', '-f', 'concat', '-safe', '0', '-i', list_path,
+                             '-c', 'copy', tmp_path])
+        if not joined or not file_has_data(tmp_path):
+            remove_if_exists(tmp_path)
+            return False
+        return True
+    finally:
+        for path in part_paths + [list_path]:
+            remove_if_exists(path)
+
+
+def run_ffmpeg(argv):
+    """
+    Run an ffmpeg command with its output discarded. Unlike call_cmd_line() this
+    reports whether it worked
+
+    Returns:
+        True if ffmpeg exited successfully
+    """
+
+    try:
+        return subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+    except OSError as e:
+        logger.error('Failed to run ffmpeg: {}'.format(e))
+        return False
+
+
+def file_has_data(path):
+    """ Check that path exists and isn't empty """
+    try:
+        return os.path.getsize(path) > 0
+    except OSError:
+        return False
+
+
+def remove_if_exists(path):
+    """ Remove path, ignoring it if it doesn't exist """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def kill_stale_arecord():
+    """
+    Terminate any arecord processes left over from a previous run, which would hold
+    the capture device. /proc is scanned directly rather than running killall, and sudo
+    is only used for processes this user isn't allowed to signal (arecord runs under sudo)
+    """
+
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{}/comm'.format(pid)) as f:
+                if f.read().strip() != 'arecord':
+                    continue
+            os.kill(int(pid), signal.SIGTERM)
+        except (FileNotFoundError, ProcessLookupError):
+            # The process exited while we were looking at it
+            continue
+        except PermissionError:
+            call_cmd_line(['sudo', 'kill', pid], use_shell=False)
+
+
+def parse_hw_params(dump):
+    """
+    Parse the output of arecord --dump-hw-params
+
+    Args:
+        dump: The text arecord printed
+
+    Returns:
+        A dictionary mapping each parameter name (e.g. 'FORMAT', 'RATE') to its value string
+    """
+
+    params = {}
+    for line in dump.splitlines():
+        name, sep, value = line.partition(':')
+        if sep and name.strip().isupper():
+            params[name.strip()] = value.strip()
+    return params
+
+
+def hw_param_allows(value, n):
+    """
+    Check whether n is allowed by a numeric hw param value, either a single number
+    or an interval such as [8000 192000]. A '(' or ')' marks an open (exclusive) bound.
+    """
+
+    value = value.strip()
+    if not value:
+        return False
+    low_open = value[0] == '('
+    high_open = value[-1] == ')'
+    bounds = value.strip('[]()').split()
+    try:
+        bounds = [int(b) for b in bounds]
+    except ValueError:
+        return False
+    if len(bounds) == 1:
+        return n == bounds[0]
+    if len(bounds) != 2:
+        return False
+    low, high = bounds
+    above_low = low < n if low_open else low <= n
+    below_high = n < high if high_open else n <= high
+    return above_low and below_high
+
+
+def alsa_capture_device(card, sample_format, rate, channels):
+    """
+    Pick the ALSA device to record from. The raw hw device is used if it supports the
+    sample format, rate and channel count natively, which skips the conversions done in
+    user space by the plug layer. Otherwise the plughw device is used.
+
+    Args:
+        card: ALSA card number
+        sample_format: arecord sample format, e.g. S32_LE
+        rate: Sample rate in Hz
+        channels: Number of channels to record
+
+    Returns:
+        'hw:<card>,0' or 'plughw:<card>,0'
+    """
+
+    hw = 'hw:{},0'.format(card)
+    try:
+        # arecord prints the hw params before it tries to open the device with the requested
+        # settings, so this succeeds quickly or records a second of audio to /dev/null
+        result = subprocess.run(['sudo', 'arecord', '--device', hw, '--dump-hw-params', '--channels', str(channels),
+                                 '--rate', str(rate), '--format', sample_format, '--duration', '1', '-t', 'raw', '/dev/null'],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf8', timeout=10)
+        params = parse_hw_params(result.stderr)
+    except (OSError, subprocess.TimeoutExpired):
+        params = {}
+
+    if (sample_format in params.get('FORMAT', '').split() and
+            hw_param_allows(params.get('RATE', ''), rate) and
+            hw_param_allows(params.get('CHANNELS', ''), channels)):
+        return hw
+    return 'plug' + hw
+
+
+# ffmpeg raw input formats matching arecord's sample formats
+ARECORD_TO_FFMPEG_FORMAT = {
+    'S16_LE': 's16le',
+    'S32_LE': 's32le',
+}
+
+
+def record_encoded(device, sample_format, rate, channels, duration, trim_secs, out_path, codec_args, amplification):
+    """
+    Record with arecord and pipe the raw samples straight into ffmpeg, which trims,
+    amplifies and encodes them as they arrive, so no uncompressed file is written.
+    The output is written under partial_path(out_path) and only renamed to out_path
+    if both processes succeeded.
+
+    Args:
+        device: ALSA capture device, from alsa_capture_device()
+        sample_format: arecord sample format, a key of ARECORD_TO_FFMPEG_FORMAT
+        rate: Sample rate in Hz
+        channels: Number of channels to record
+        duration: How long to record for in seconds, including trim_secs
+        trim_secs: How many seconds to drop from the start of the audio
+        out_path: The file to write, its extension picks the container
+        codec_args: ffmpeg codec arguments, from mp3_encoder_args(), or [] for the container's default
+        amplification: Factor to amplify the audio by
+
+    Returns:
+        True if out_path was written, False if arecord or ffmpeg failed
+    """
+
+    tmp_path = partial_path(out_path)
+    rec_argv = ['sudo', 'arecord', '--device', device, '--channels', str(channels), '--rate', str(rate),
+                '--format', sample_format, '--duration', str(duration), '-t', 'raw']
+    enc_argv = (['ffmpeg', '-loglevel', 'panic', '-f', ARECORD_TO_FFMPEG_FORMAT[sample_format],
+                 '-ar', str(rate), '-ac', str(channels), '-i', 'pipe:0', '-ss', str(trim_secs)] +
+                codec_args + volume_filter_args(amplification) + [tmp_path])
+
+    # Connect the two processes directly rather than through a shell pipeline
+    with subprocess.Popen(rec_argv, stdout=subprocess.PIPE) as rec:
+        with subprocess.Popen(enc_argv, stdin=rec.stdout, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL) as enc:
+            # Only ffmpeg should hold the read end, so arecord gets SIGPIPE if ffmpeg dies
+            rec.stdout.close()
+            enc.wait()
+        rec.wait()
+
+    if rec.returncode != 0 or enc.returncode != 0 or not file_has_data(tmp_path):
+        logger.error('Recording to {} failed, arecord exited with {} and ffmpeg with {}'.format(
+            out_path, rec.returncode, enc.returncode))
+        remove_if_exists(tmp_path)
+        return False
+    os.replace(tmp_path, out_path)
+    return True
+
+
+# Layer III bitrates in kbps by bitrate index, for MPEG-1 and for MPEG-2/2.5
+MP3_BITRATES_KBPS = {
+    'mpeg1': (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    'mpeg2': (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+# Sample rates by the version bits of the frame header (3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5)
+MP3_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    0: (11025, 12000, 8000),
+}
+
+
+def mp3_frame_info(header):
+    """
+    Parse an MPEG audio Layer III frame header
+
+    Args:
+        header: At least the first 4 bytes of the frame
+
+    Returns:
+        (frame length in bytes, samples per frame), or None if header isn't a valid frame header
+    """
+
+    if len(header) < 4:
+        return None
+    h = int.from_bytes(header[:4], 'big')
+    version = (h >> 19) & 3
+    layer = (h >> 17) & 3
+    bitrate_idx = (h >> 12) & 0xF
+    rate_idx = (h >> 10) & 3
+    padding = (h >> 9) & 1
+    if h >> 21 != 0x7FF or version == 1 or layer != 1 or bitrate_idx in (0, 15) or rate_idx == 3:
+        return None
+
+    rate = MP3_SAMPLE_RATES[version][rate_idx]
+    if version == 3:
+        return 144000 * MP3_BITRATES_KBPS['mpeg1'][bitrate_idx] // rate + padding, 1152
+    return 72000 * MP3_BITRATES_KBPS['mpeg2'][bitrate_idx] // rate + padding, 576
@@ -1,10 +1,11 @@
 import os
-import shutil
 import logging
 import datetime
-from buggd.apps.buggd.utils import call_cmd_line
+from buggd.apps.buggd.utils import call_cmd_line, partial_path, publish_file
 from buggd.drivers.soundcard import Soundcard
-from .option import set_option
+from .option import set_option, options_by_name
+from .wavfile import trim_wav_start, amplify_wav
+from .audio import kill_stale_arecord, alsa_capture_device, mp3_encoder_args, volume_filter_args, encode_mp3, record_encoded, file_has_data
 from .sensorbase import SensorBase
 
 logger = logging.getLogger(__name__)
@@ -22,17 +23,20 @@ class ExternalMic(SensorBase):
         logger.info('Initialising the soundcard')
         self.soundcard = Soundcard()
 
-        call_cmd_line('sudo killall arecord')
+        kill_stale_arecord()
 
         # Initialise the sensor config, double checking the types of values. This
         # code uses the variables named and described in the config static to set
         # defaults and override with any passed in the config file.
-        opts = self.options()
-        opts = {var['name']: var for var in opts}
+        opts = options_by_name(type(self))
 
         self.record_length = set_option('record_length', config, opts)
         self.record_freq = set_option('record_freq', config, opts)
         self.compress_data = set_option('compress_data', config, opts)
+        self.mp3_encoder = set_option('mp3_encoder', config, opts)
+        self.mp3_codec_args = mp3_encoder_args(self.mp3_encoder)
+        self.parallel_encode_workers = set_option('parallel_encode_workers', config, opts)
+        self.encode_while_recording = set_option('encode_while_recording', config, opts)
         self.amplification = set_option('amplification', config, opts)
         self.capture_delay = set_option('capture_delay', config, opts)
         self.capture_card = set_option('capture_card', config, opts)
@@ -46,6 +50,7 @@ class ExternalMic(SensorBase):
         self.rec_start_trim_secs = 1 # To remove popping from start of audio recordings
         self.working_dir = None
         self.data_dir = None
+        self.alsa_device = 'plughw:{},0'.format(self.capture_card) # Replaced by setup() if the hw device will do
         self.server_sync_interval = self.record_length + self.capture_delay
 
         # Power on the soundcard, with phantom power off and gain set to 0dB
@@ -74,6 +79,18 @@ class ExternalMic(SensorBase):
                  'type': bool,
                  'default': True,
                  'prompt': 'Should the audio data be compressed from WAV to VBR mp3?'},
+                {'name': 'mp3_encoder',
+                 'type': str,
+                 'default': 'shine',
+                 'prompt': 'Which mp3 encoder should compress the audio? (\'shine\' = fast fixed bitrate, \'lame\' = slower VBR)'},
+                {'name': 'parallel_encode_workers',
+                 'type': int,
+                 'default': 1,
+                 'prompt': 'How many ffmpeg processes should encode each recording in parallel? (at most the number of CPU cores)'},
+                {'name': 'encode_while_recording',
+                 'type': bool,
+                 'default': False,
+                 'prompt': 'Should arecord be piped straight into the encoder, rather than writing a WAV file to encode afterwards?'},
                 {'name': 'amplification',
                  'type': int,
                  'default': 1,
@@ -102,6 +119,8 @@ class ExternalMic(SensorBase):
 
 
     def setup(self):
+        self.alsa_device = alsa_capture_device(self.capture_card, 'S16_LE', self.record_freq, self.channels)
+        logger.info('Recording from ALSA device {}'.format(self.alsa_device))
         return True
 
 
@@ -119,10 +138,10 @@ class ExternalMic(SensorBase):
         self.data_dir = data_dir
 
         # Name files by start time and duration (accounting for time stripped from the start of the recording)
-        start_time_dt = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.rec_start_trim_secs)
-        start_time = start_time_dt.isoformat()[:-3]+'Z' # Remove extra millisecond accuracy and add Z to denote UTC timezone
-        start_time = start_time.replace(':','_') # Replace colons with dots (can't have colon in filenames)
-        uncomp_f_name = '{}'.format(start_time)
+        # Underscores replace the colons (can't have colon in filenames), to millisecond accuracy with Z to denote UTC
+        start_time_dt = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.rec_start_trim_secs)
+        start_time = start_time_dt.strftime('%Y-%m-%dT%H_%M_%S.') + '{:03d}Z'.format(start_time_dt.microsecond // 1000)
+        uncomp_f_name = start_time
 
         # Create appropriate message for the log
         if self.enable_internal_mic:
@@ -133,52 +152,93 @@ class ExternalMic(SensorBase):
 
         logger.info('Started recording {} at {} for {}s'.format(what, start_time, self.record_length))
         wfile = os.path.join(self.working_dir, self.working_file)
-        wfile_trimmed = os.path.join(self.working_dir, 'trimmed_{}'.format(self.working_file))
 
-        # Record audio at given freq and duration using the arecord command
-        rec_cmd = 'sudo arecord --device plughw:{},0 --channels {} --rate {} --format S16_LE --duration {} {}'
-        call_cmd_line(rec_cmd.format(self.capture_card, self.channels, self.record_freq, self.record_length + self.rec_start_trim_secs, wfile))
+        if self.encode_while_recording:
+            # Encode the audio as it's captured, postprocess() only has to stage the file for upload
+            recorded = record_encoded(self.alsa_device, 'S16_LE', self.record_freq, self.channels,
+                                      self.record_length + self.rec_start_trim_secs, self.rec_start_trim_secs,
+                                      os.path.join(self.working_dir, uncomp_f_name + self.output_ext()),
+                                      self.mp3_codec_args if self.compress_data else [], self.amplification)
+            if recorded:
+                logger.info('{} - Finished recording'.format(uncomp_f_name))
+            else:
+                logger.error('{} - Recording failed'.format(uncomp_f_name))
+            return uncomp_f_name
 
-        # Trim the first N seconds of audio to remove the 'popping' sound
-        trim_cmd = 'ffmpeg -y -loglevel panic -i {} -ss {} {} >/dev/null 2>&1'
-        call_cmd_line(trim_cmd.format(wfile, self.rec_start_trim_secs, wfile_trimmed))
-        os.remove(wfile)
+        # Record audio at given freq and duration using the arecord command
+        rec_cmd = ['sudo', 'arecord', '--device', self.alsa_device, '--channels', str(self.channels),
+                   '--rate', str(self.record_freq), '--format', 'S16_LE',
+                   '--duration', str(self.record_length + self.rec_start_trim_secs), wfile]
+        call_cmd_line(rec_cmd, use_shell=False)
 
-        # Move the recorded (and trimmed) file to a location where it will get compressed
-        shutil.move(wfile_trimmed, os.path.join(self.working_dir, uncomp_f_name))
+        # Move the recorded file to a location where it will get trimmed and compressed
+        os.replace(wfile, os.path.join(self.working_dir, uncomp_f_name))
 
         logger.info('{} - Finished recording'.format(uncomp_f_name))
 
         return uncomp_f_name
 
+    def output_ext(self):
+        """ The extension of the final data files """
+        return '.mp3' if self.compress_data else '.wav'
+
     def postprocess(self, uncomp_f_name, cmd_on_complete=None):
         """
         Method to optionally compress raw audio data to mp3 format and stage data to
         upload folder
         """
 
+        if self.encode_while_recording:
+            # capture_data() already encoded the file, so just move it to the upload folder
+            out_name = uncomp_f_name + self.output_ext()
+            out_path = os.path.join(self.working_dir, out_name)
+            if file_has_data(out_path):
+                publish_file(out_path, os.path.join(self.data_dir, out_name))
+            else:
+                logger.error('{} - No encoded recording to stage for upload'.format(uncomp_f_name))
+            if cmd_on_complete:
+                call_cmd_line(cmd_on_complete)
+            return
+
         # current working file
         uncomp_path = os.path.join(self.working_dir, uncomp_f_name)
 
+        # Trim the first N seconds of audio to remove the 'popping' sound. This is done here
+        # rather than in capture_data() so it overlaps with the next recording instead of delaying it
+        trimmed_path = os.path.join(self.working_dir, 'trimmed_{}'.format(uncomp_f_name))
+        trim_wav_start(uncomp_path, trimmed_path, self.rec_start_trim_secs)
+        os.remove(uncomp_path)
+        uncomp_path = trimmed_path
+
         if self.compress_data == True:
             # Compress the raw audio file to mp3 format
             comp_path = os.path.join(self.data_dir, uncomp_f_name) + '.mp3'
             logger.info('{} - Starting compression'.format(uncomp_f_name))
-            cmd = ('ffmpeg -loglevel panic -i {} -codec:a libmp3lame -filter:a "volume={}" -qscale:a 0 -ac {} {} >/dev/null 2>&1') # VBR compression
-            #cmd = ('ffmpeg -loglevel panic -i {} -codec:a libmp3lame -filter:a "volume=5" -b:a 192k -ac 1 {} >/dev/null 2>&1') # CBR compression
-            call_cmd_line(cmd.format(uncomp_path, self.amplification, self.channels, comp_path))
-            logger.info('{} - Finished audio compression'.format(uncomp_f_name))
+            if encode_mp3(uncomp_path, comp_path, self.mp3_codec_args, self.amplification, self.channels,
+                          self.record_length, self.parallel_encode_workers):
+                logger.info('{} - Finished audio compression'.format(uncomp_f_name))
+            else:
+                # Keep the only copy of the audio rather than deleting it below
+                logger.error('{} - Audio compression failed, leaving {} in place'.format(uncomp_f_name, uncomp_path))
+                uncomp_path = None
 
         else:
-            # Don't compress but still amplify the audio and store as WAV
+            # Don't compress but still amplify the audio and store as WAV. The samples are scaled
+            # in place, falling back to an ffmpeg pass if numpy isn't installed
             logger.info('{} - No compression of audio data, just amplification'.format(uncomp_f_name))
             out_path = os.path.join(self.data_dir, uncomp_f_name) + '.wav'
-            cmd = ('ffmpeg -loglevel panic -i {} -filter:a "volume={}" {} >/dev/null 2>&1')
-            call_cmd_line(cmd.format(uncomp_path, self.amplification, out_path))
+            if amplify_wav(uncomp_path, self.amplification):
+                publish_file(uncomp_path, out_path)
+            else:
+                tmp_path = partial_path(out_path)
+                cmd = ['ffmpeg', '-loglevel', 'panic', '-i', uncomp_path] + volume_filter_args(self.amplification) + [tmp_path]
+                call_cmd_line(cmd, use_shell=False)
+                if os.path.exists(tmp_path):
+                    os.replace(tmp_path, out_path)
             logger.info('{} - Finished audio amplification'.format(uncomp_f_name))
 
         # Remove the old working file
-        if os.path.exists(uncomp_path):
+        if uncomp_path is not None and os.path.exists(uncomp_path):
             os.remove(uncomp_path)
 
         if cmd_on_complete:
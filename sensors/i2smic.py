@@ -1,18 +1,25 @@
 import os
-import shutil
 import logging
 import datetime
 import subprocess
 import queue
-import tempfile
-import wave
+import threading
 
-from buggd.apps.buggd.utils import call_cmd_line
+from buggd.apps.buggd.utils import call_cmd_line, partial_path, publish_file
 from buggd.drivers.soundcard import Soundcard
-from .option import set_option
+from .option import set_option, options_by_name
+from .wavfile import trim_wav_start, amplify_wav_to_s16, patch_wav_sizes
+from .audio import kill_stale_arecord, alsa_capture_device, mp3_encoder_args, volume_filter_args, encode_mp3, record_encoded, file_has_data, mp3_frame_info
 from .sensorbase import SensorBase
 
 logger = logging.getLogger(__name__)
+
+# Length of the chunks of audio sent by the continuous stream
+STREAM_CHUNK_SECS = 0.3
+
+# The continuous stream logs a progress summary every this many chunks (30s), rather than a line per chunk
+STREAM_LOG_EVERY_CHUNKS = 100
+
 class I2SMic(SensorBase):
 
     def __init__(self, config=None):
@@ -27,17 +34,20 @@ class I2SMic(SensorBase):
         sc = Soundcard()
         sc.enable_internal_channel()
 
-        call_cmd_line('sudo killall arecord')
+        kill_stale_arecord()
 
         # Initialise the sensor config, double checking the types of values. This
         # code uses the variables named and described in the config static to set
         # defaults and override with any passed in the config file.
-        opts = self.options()
-        opts = {var['name']: var for var in opts}
+        opts = options_by_name(type(self))
 
         self.record_length = set_option('record_length', config, opts)
         self.record_freq = set_option('record_freq', config, opts)
         self.compress_data = set_option('compress_data', config, opts)
+        self.mp3_encoder = set_option('mp3_encoder', config, opts)
+        self.mp3_codec_args = mp3_encoder_args(self.mp3_encoder)
+        self.parallel_encode_workers = set_option('parallel_encode_workers', config, opts)
+        self.encode_while_recording = set_option('encode_while_recording', config, opts)
         self.amplification = set_option('amplification', config, opts)
         self.capture_delay = set_option('capture_delay', config, opts)
         self.capture_card = set_option('capture_card', config, opts)
@@ -47,6 +57,7 @@ class I2SMic(SensorBase):
         self.rec_start_trim_secs = 1 # To remove popping from start of audio recordings
         self.working_dir = None
         self.data_dir = None
+        self.alsa_device = 'plughw:{},0'.format(self.capture_card) # Replaced by setup() if the hw device will do
         self.server_sync_interval = self.record_length + self.capture_delay
 
     @staticmethod
@@ -66,6 +77,18 @@ class I2SMic(SensorBase):
                  'type': bool,
                  'default': True,
                  'prompt': 'Should the audio data be compressed from WAV to VBR mp3?'},
+                {'name': 'mp3_encoder',
+                 'type': str,
+                 'default': 'shine',
+                 'prompt': 'Which mp3 encoder should compress the audio? (\'shine\' = fast fixed bitrate, \'lame\' = slower VBR)'},
+                {'name': 'parallel_encode_workers',
+                 'type': int,
+                 'default': 1,
+                 'prompt': 'How many ffmpeg processes should encode each recording in parallel? (at most the number of CPU cores)'},
+                {'name': 'encode_while_recording',
+                 'type': bool,
+                 'default': False,
+                 'prompt': 'Should arecord be piped straight into the encoder, rather than writing a WAV file to encode afterwards?'},
                 {'name': 'amplification',
                  'type': int,
                  'default': 5,
@@ -84,6 +107,8 @@ class I2SMic(SensorBase):
     def setup(self):
         #TODO: Currently the internal I2S mic is set to max volume in the pcmd3180_i2c_init.sh script.
         # This seems to be a good default, but we may want to add a volume setting to the config file in the future.
+        self.alsa_device = alsa_capture_device(self.capture_card, 'S32_LE', self.record_freq, 1)
+        logger.info('Recording from ALSA device {}'.format(self.alsa_device))
         return True
 
 
@@ -101,59 +126,102 @@ class I2SMic(SensorBase):
         self.data_dir = data_dir
 
         # Name files by start time and duration (accounting for time stripped from the start of the recording)
-        start_time_dt = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.rec_start_trim_secs)
-        start_time = start_time_dt.isoformat()[:-3]+'Z' # Remove extra millisecond accuracy and add Z to denote UTC timezone
-        start_time = start_time.replace(':','_') # Replace colons with dots (can't have colon in filenames)
-        uncomp_f_name = '{}'.format(start_time)
+        # Underscores replace the colons (can't have colon in filenames), to millisecond accuracy with Z to denote UTC
+        start_time_dt = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.rec_start_trim_secs)
+        start_time = start_time_dt.strftime('%Y-%m-%dT%H_%M_%S.') + '{:03d}Z'.format(start_time_dt.microsecond // 1000)
+        uncomp_f_name = start_time
 
         # Record for a specific duration
         logger.info('Started recording mono from internal mic at {} for {}s'.format(start_time, self.record_length))
         wfile = os.path.join(self.working_dir, self.working_file)
-        wfile_trimmed = os.path.join(self.working_dir, 'trimmed_{}'.format(self.working_file))
 
-        # Record audio at given freq and duration using the arecord command
-        rec_cmd = 'sudo arecord --device plughw:{},0 -c1 --rate {} --format S32_LE --duration {} {}'
-        call_cmd_line(rec_cmd.format(self.capture_card, self.record_freq, self.record_length + self.rec_start_trim_secs, wfile))
+        if self.encode_while_recording:
+            # Encode the audio as it's captured, postprocess() only has to stage the file for upload
+            recorded = record_encoded(self.alsa_device, 'S32_LE', self.record_freq, 1,
+                                      self.record_length + self.rec_start_trim_secs, self.rec_start_trim_secs,
+                                      os.path.join(self.working_dir, uncomp_f_name + self.output_ext()),
+                                      self.mp3_codec_args if self.compress_data else [], self.amplification)
+            if recorded:
+                logger.info('{} - Finished recording'.format(uncomp_f_name))
+            else:
+                logger.error('{} - Recording failed'.format(uncomp_f_name))
+            return uncomp_f_name
 
-        # Trim the first N seconds of audio to remove the 'popping' sound
-        trim_cmd = 'ffmpeg -y -loglevel panic -i {} -ss {} {} >/dev/null 2>&1'
-        call_cmd_line(trim_cmd.format(wfile, self.rec_start_trim_secs, wfile_trimmed))
-        os.remove(wfile)
+        # Record audio at given freq and duration using the arecord command
+        rec_cmd = ['sudo', 'arecord', '--device', self.alsa_device, '-c1', '--rate', str(self.record_freq),
+                   '--format', 'S32_LE', '--duration', str(self.record_length + self.rec_start_trim_secs), wfile]
+        call_cmd_line(rec_cmd, use_shell=False)
 
-        # Move the recorded (and trimmed) file to a location where it will get compressed
-        shutil.move(wfile_trimmed, os.path.join(self.working_dir, uncomp_f_name))
+        # Move the recorded file to a location where it will get trimmed and compressed
+        os.replace(wfile, os.path.join(self.working_dir, uncomp_f_name))
 
         logger.info('{} - Finished recording'.format(uncomp_f_name))
 
         return uncomp_f_name
 
+    def output_ext(self):
+        """ The extension of the final data files """
+        return '.mp3' if self.compress_data else '.wav'
+
     def postprocess(self, uncomp_f_name, cmd_on_complete=None):
         """
         Method to optionally compress raw audio data to mp3 format and stage data to
         upload folder
         """
+        if self.encode_while_recording:
+            # capture_data() already encoded the file, so just move it to the upload folder
+            out_name = uncomp_f_name + self.output_ext()
+            out_path = os.path.join(self.working_dir, out_name)
+            if file_has_data(out_path):
+                publish_file(out_path, os.path.join(self.data_dir, out_name))
+            else:
+                logger.error('{} - No encoded recording to stage for upload'.format(uncomp_f_name))
+            if cmd_on_complete:
+                call_cmd_line(cmd_on_complete)
+            return
+
         # current working file
         uncomp_path = os.path.join(self.working_dir, uncomp_f_name)
 
+        # Trim the first N seconds of audio to remove the 'popping' sound. This is done here
+        # rather than in capture_data() so it overlaps with the next recording instead of delaying it
+        trimmed_path = os.path.join(self.working_dir, 'trimmed_{}'.format(uncomp_f_name))
+        trim_wav_start(uncomp_path, trimmed_path, self.rec_start_trim_secs)
+        os.remove(uncomp_path)
+        uncomp_path = trimmed_path
+
         if self.compress_data == True:
             # Compress the raw audio file to mp3 format
             comp_path = os.path.join(self.data_dir, uncomp_f_name) + '.mp3'
             logger.info('{} - Starting compression'.format(uncomp_f_name))
-            cmd = ('ffmpeg -loglevel panic -i {} -codec:a libmp3lame -filter:a "volume={}" -qscale:a 0 -ac 1 {} >/dev/null 2>&1') # VBR compression
-            #cmd = ('ffmpeg -loglevel panic -i {} -codec:a libmp3lame -filter:a "volume=5" -b:a 192k -ac 1 {} >/dev/null 2>&1') # CBR compression
-            call_cmd_line(cmd.format(uncomp_path, self.amplification, comp_path))
-            logger.info('{} - Finished audio compression'.format(uncomp_f_name))
+            if encode_mp3(uncomp_path, comp_path, self.mp3_codec_args, self.amplification, 1,
+                          self.record_length, self.parallel_encode_workers):
+                logger.info('{} - Finished audio compression'.format(uncomp_f_name))
+            else:
+                # Keep the only copy of the audio rather than deleting it below
+                logger.error('{} - Audio compression failed, leaving {} in place'.format(uncomp_f_name, uncomp_path))
+                uncomp_path = None
 
         else:
-            # Don't compress but still amplify the audio and store as WAV
+            # Don't compress but still amplify the audio and store as 16 bit WAV, like the stream and
+            # encode_while_recording. The samples are converted with numpy, falling back to an
+            # ffmpeg pass if numpy isn't installed
             logger.info('{} - No compression of audio data, just amplification'.format(uncomp_f_name))
             out_path = os.path.join(self.data_dir, uncomp_f_name) + '.wav'
-            cmd = ('ffmpeg -loglevel panic -i {} -filter:a "volume={}" {} >/dev/null 2>&1')
-            call_cmd_line(cmd.format(uncomp_path, self.amplification, out_path))
+            s16_path = os.path.join(self.working_dir, 's16_{}'.format(uncomp_f_name))
+            if amplify_wav_to_s16(uncomp_path, s16_path, self.amplification):
+                publish_file(s16_path, out_path)
+            else:
+                tmp_path = partial_path(out_path)
+                cmd = (['ffmpeg', '-loglevel', 'panic', '-i', uncomp_path] + volume_filter_args(self.amplification) +
+                       ['-codec:a', 'pcm_s16le', tmp_path])
+                call_cmd_line(cmd, use_shell=False)
+                if os.path.exists(tmp_path):
+                    os.replace(tmp_path, out_path)
             logger.info('{} - Finished audio amplification'.format(uncomp_f_name))
 
         # Remove the old working file
-        if os.path.exists(uncomp_path):
+        if uncomp_path is not None and os.path.exists(uncomp_path):
             os.remove(uncomp_path)
 
         if cmd_on_complete:
@@ -163,24 +231,36 @@ class I2SMic(SensorBase):
     def capture_continous_data(self, q_raw:queue.Queue, die_event):     
         cmd = ['sudo',
             'arecord',
-            '--device', f'plughw:{self.capture_card},0',
+            '--device', self.alsa_device,
             '-c1',
             '--rate', str(self.record_freq),
             '--format', 'S32_LE',
             '-t', 'raw',
             '-B', '10000'
         ]
-        BLOCK_SIZE = int(self.record_freq * 0.3 * 4)  # octets
+        BLOCK_SIZE = int(self.record_freq * STREAM_CHUNK_SECS * 4)  # octets
         logger.info(f"started recording with block size of len : {BLOCK_SIZE}")
+
+        # Chunks are read into a fixed pool of buffers rather than new bytes objects.
+        # q_raw carries (buffer, length) and continous_data_compression hands each
+        # buffer back once it's finished with it.
+        self.free_buffers = queue.Queue()
+        for _ in range((q_raw.maxsize or 50) + 2):
+            self.free_buffers.put(bytearray(BLOCK_SIZE))
+
+        n_chunks = 0
         try:
             with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
                 while not die_event.is_set():
-                    chunk = proc.stdout.read(BLOCK_SIZE)
-                    if not chunk:
+                    buf = self.free_buffers.get()
+                    n = proc.stdout.readinto(buf)
+                    if not n:
                         logger.info("No chunk detected")
                         break
-                    logger.info(f"Captured raw of size {len(chunk)}")
-                    q_raw.put(chunk)
+                    q_raw.put((buf, n))
+                    n_chunks += 1
+                    if n_chunks % STREAM_LOG_EVERY_CHUNKS == 0:
+                        logger.info("Captured %d chunks", n_chunks)
         finally:
             proc.terminate()
             proc.wait()
@@ -192,55 +272,132 @@ class I2SMic(SensorBase):
         Pull raw PCM chunks off q_raw, optionally compress to MP3 or wrap as WAV,
         then push the resul bytes into q_ready.
         """
+        # ffmpeg reads raw audio on stdin and writes the result to stdout, so nothing touches the disk
+        cmd = ['ffmpeg', '-loglevel', 'panic',
+               '-f', 's32le', '-ar', str(self.record_freq), '-ac', '1', '-i', 'pipe:0']
+        cmd += volume_filter_args(self.amplification)
+        if self.compress_data:
+            # One long-lived encoder for the whole stream, which keeps its state (and bit
+            # reservoir) across chunks. A reader thread cuts its output into chunks of whole frames
+            cmd += self.mp3_codec_args + ['-ac', '1', '-id3v2_version', '0', '-write_xing', '0',
+                                          '-flush_packets', '1', '-f', 'mp3', 'pipe:1']
+            encoder, reader = self.start_mp3_encoder(cmd, q_ready)
+        else:
+            # Each chunk is a complete WAV file, so run ffmpeg once per chunk
+            cmd += ['-f', 'wav', 'pipe:1']
+
+        n_chunks = 0
         while not die_event.is_set():
-            logger.info("Waiting for raw audio...")
-            raw = q_raw.get()
-            logger.info(f"Got raw audio of size: {len(raw)}")
+            buf, n = q_raw.get()
+            raw = memoryview(buf)[:n]
             try:
-                # 1) Write raw PCM into a WAV temp file
-                with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp_wav:
-                    wav_path = tmp_wav.name
-                    # write a minimal WAV header + raw data
-                    with wave.open(tmp_wav, 'wb') as wf:
-                        wf.setnchannels(1)
-                        wf.setsampwidth(4)      # S32_LE → 4 bytes/sample
-                        wf.setframerate(self.record_freq)
-                        wf.writeframes(raw)
-
                 if self.compress_data:
-                    # 2a) Compress to MP3 via ffmpeg, writing to another temp file
-                    mp3_path = wav_path + ".mp3"
-                    cmd = (
-                        f'ffmpeg -y -loglevel panic -i {wav_path} '
-                        f'-codec:a libmp3lame -filter:a "volume={self.amplification}" '
-                        f'-qscale:a 0 -ac 1 {mp3_path} >/dev/null 2>&1'
-                    )
-                    call_cmd_line(cmd)
-                    # 3a) Read the MP3 bytes
-                    with open(mp3_path, 'rb') as f:
-                        data = f.read()
-                    os.remove(mp3_path)
-
+                    # Start a new encoder if the last one died, rather than losing the rest of the stream
+                    if encoder.poll() is not None:
+                        logger.error("[transform] mp3 encoder exited with code %s, restarting it", encoder.returncode)
+                        encoder, reader = self.restart_mp3_encoder(encoder, reader, cmd, q_ready)
+
+                    # The reader thread enqueues the MP3 frames as they come out
+                    try:
+                        encoder.stdin.write(raw)
+                        encoder.stdin.flush()
+                    except OSError as e:
+                        logger.error("[transform] writing to mp3 encoder failed: %s, restarting it", e)
+                        encoder, reader = self.restart_mp3_encoder(encoder, reader, cmd, q_ready)
+                        encoder.stdin.write(raw)
+                        encoder.stdin.flush()
                 else:
-                    # 2b) Just re-wrap as WAV with volume filter
-                    amplified_wav = wav_path + ".out.wav"
-                    cmd = (
-                        f'ffmpeg -y -loglevel panic -i {wav_path} '
-                        f'-filter:a "volume={self.amplification}" {amplified_wav} >/dev/null 2>&1'
-                    )
-                    call_cmd_line(cmd)
-                    with open(amplified_wav, 'rb') as f:
-                        data = f.read()
-                    os.remove(amplified_wav)
-
-                # 4) Enqueue the final bytes
-                q_ready.put(data)
+                    # Amplify and wrap as WAV, then enqueue the final bytes
+                    result = subprocess.run(cmd, input=raw, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+                    q_ready.put(patch_wav_sizes(result.stdout))
 
             except Exception as e:
                 logger.error(f"[transform] error processing chunk: {e}")
 
             finally:
-                # Clean up the original WAV temp
-                if os.path.exists(wav_path):
-                    os.remove(wav_path)
+                # Hand the buffer back to the capture thread
+                raw.release()
+                self.free_buffers.put(buf)
                 q_raw.task_done()
+
+            n_chunks += 1
+            if n_chunks % STREAM_LOG_EVERY_CHUNKS == 0:
+                logger.info("Processed %d chunks", n_chunks)
+
+        if self.compress_data:
+            # Closing stdin makes ffmpeg flush the last frames and exit
+            try:
+                encoder.stdin.close()
+            except OSError:
+                pass
+            reader.join()
+            encoder.wait()
+
+
+    def start_mp3_encoder(self, cmd, q_ready):
+        """
+        Start the stream's ffmpeg mp3 encoder and the thread forwarding its output to q_ready
+
+        Returns:
+            (encoder process, reader thread)
+        """
+        encoder = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        reader = threading.Thread(target=self.forward_mp3_frames,
+                                  args=(encoder.stdout, q_ready, int(self.record_freq * STREAM_CHUNK_SECS)))
+        reader.start()
+        return encoder, reader
+
+
+    def restart_mp3_encoder(self, encoder, reader, cmd, q_ready):
+        """
+        Stop a failed encoder, wait for its reader thread to finish, and start new ones
+
+        Returns:
+            (encoder process, reader thread)
+        """
+        try:
+            encoder.stdin.close()
+        except OSError:
+            pass
+        if encoder.poll() is None:
+            encoder.kill()
+        encoder.wait()
+        reader.join()
+        encoder.stdout.close()
+        return self.start_mp3_encoder(cmd, q_ready)
+
+
+    def forward_mp3_frames(self, stdout, q_ready, chunk_samples):
+        """
+        Read the encoder's MP3 stream and put it on q_ready in chunks of whole frames,
+        each holding at least chunk_samples samples of audio
+        """
+        pending = bytearray()
+        pos = 0         # End of the complete frames in pending
+        samples = 0     # Samples in pending[:pos]
+        while True:
+            data = stdout.read1(65536)
+            if not data:
+                break
+            pending += data
+
+            while len(pending) - pos >= 4:
+                info = mp3_frame_info(pending[pos:pos + 4])
+                if info is None:
+                    # Not at a frame header, drop the byte and look for the next one
+                    del pending[pos]
+                    continue
+                length, frame_samples = info
+                if len(pending) - pos < length:
+                    break
+                pos += length
+                samples += frame_samples
+
+                if samples >= chunk_samples:
+                    q_ready.put(bytes(pending[:pos]))
+                    del pending[:pos]
+                    pos = 0
+                    samples = 0
+
+        if pos:
+            q_ready.put(bytes(pending[:pos]))
@@ -1,3 +1,22 @@
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def options_by_name(sensor_cls):
+    """
+    Index a sensor class's options by name. The result is built once per class
+    and shared, so it must not be modified.
+
+    Args:
+        sensor_cls: A sensor class with an options() static method
+
+    Returns:
+        A dictionary mapping each option name to its options() entry
+    """
+
+    return {var['name']: var for var in sensor_cls.options()}
+
+
 def set_option(var, config, opts):
     """
     Method to compare the provided and default config for a class variable
@@ -13,10 +32,7 @@ def set_option(var, config, opts):
     """
 
     this_opt = opts[var]
-    if 'default' in this_opt.keys():
-        default_val = this_opt['default']
-    else:
-        default_val = None
+    default_val = this_opt.get('default')
 
     # check if there is a config value of the right type
     val_type = this_opt['type']
@@ -1,6 +1,6 @@
 import datetime
 import time
-from .option import set_option
+from .option import set_option, options_by_name
 
 class SensorBase(object):
 
@@ -17,8 +17,7 @@ class SensorBase(object):
         # Initialise the sensor config, double checking the types of values. This
         # code uses the variables named and described in the config static to set
         # defaults and override with any passed in the config file.
-        opts = self.options()
-        opts = {var['name']: var for var in opts}
+        opts = options_by_name(type(self))
 
         # config options
         self.capture_delay = set_option('capture_delay', config, opts)
@@ -57,7 +56,7 @@ class SensorBase(object):
         """
         self.working_dir = working_dir
         self.data_dir = data_dir
-        self.current_file = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+        self.current_file = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
 
     def postprocess(self):
         pass
@@ -0,0 +1,228 @@
+import os
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Samples amplified per step by amplify_wav, bounds its memory use
+AMPLIFY_BLOCK_SAMPLES = 1 << 20
+
+
+def read_wav_header(f, path):
+    """
+    Read a WAV file's chunks up to the start of the audio data, leaving f positioned there.
+
+    Args:
+        f: The WAV file, opened in binary mode at its start
+        path: The file's path, for error messages
+
+    Returns:
+        (header bytes before the data chunk, sample rate, block align, bits per sample,
+        size given in the data chunk header)
+    """
+
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise ValueError('{} is not a WAV file'.format(path))
+
+    # Copy every chunk before the audio data, noting the sample layout from the fmt chunk
+    header = bytearray(riff)
+    fmt = None
+    while True:
+        chunk_hdr = f.read(8)
+        if len(chunk_hdr) < 8:
+            raise ValueError('{} has no data chunk'.format(path))
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk_hdr)
+        if chunk_id == b'data':
+            break
+        body = f.read(chunk_size + (chunk_size & 1))
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack('<HHIIHH', body[:16])
+        header += chunk_hdr + body
+
+    if fmt is None:
+        raise ValueError('{} has no fmt chunk'.format(path))
+
+    _, _, rate, _, block_align, bits = fmt
+    return header, rate, block_align, bits, chunk_size
+
+
+def trim_wav_start(in_path, out_path, trim_secs):
+    """
+    Copy a PCM WAV file, dropping the first trim_secs seconds of audio.
+
+    Rather than decoding and re-encoding the audio, the header is copied with the
+    sizes patched and the remaining sample data is copied by the kernel with sendfile.
+    Where the filesystem supports O_TMPFILE the copy is written to an unnamed file
+    which is only linked in as out_path once complete.
+
+    Args:
+        in_path: The WAV file to trim
+        out_path: Where to write the trimmed WAV file
+        trim_secs: How many seconds to remove from the start of the audio
+    """
+
+    with open(in_path, 'rb') as f_in:
+        header, rate, block_align, _, chunk_size = read_wav_header(f_in, in_path)
+
+        # The data size in the header can be wrong if the recording was cut short
+        data_start = f_in.tell()
+        data_len = min(chunk_size, os.fstat(f_in.fileno()).st_size - data_start)
+        data_len -= data_len % block_align
+        skip = min(trim_secs * rate * block_align, data_len)
+        remaining = data_len - skip
+
+        header += struct.pack('<4sI', b'data', remaining)
+        struct.pack_into('<I', header, 4, len(header) - 8 + remaining)
+
+        try:
+            fd = os.open(os.path.dirname(out_path) or '.', os.O_TMPFILE | os.O_WRONLY, 0o644)
+            unnamed = True
+        except (AttributeError, OSError):
+            fd = os.open(out_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            unnamed = False
+
+        with open(fd, 'wb') as f_out:
+            f_out.write(header)
+            f_out.flush()
+
+            offset = data_start + skip
+            while remaining > 0:
+                sent = os.sendfile(f_out.fileno(), f_in.fileno(), offset, remaining)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+
+            if unnamed:
+                # Passing a dir fd makes os.link use linkat() with AT_SYMLINK_FOLLOW,
+                # which links the file behind the /proc symlink rather than the symlink
+                proc_fds = os.open('/proc/self/fd', os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    os.link(str(fd), out_path, src_dir_fd=proc_fds)
+                finally:
+                    os.close(proc_fds)
+
+
+def patch_wav_sizes(wav):
+    """
+    Fill in the RIFF and data chunk sizes of a WAV file held in memory. ffmpeg can't
+    seek back to write them when it writes a WAV file to a pipe.
+
+    Args:
+        wav: The WAV file contents
+
+    Returns:
+        The WAV file contents with the sizes set, as bytes
+    """
+
+    wav = bytearray(wav)
+    pos = 12
+    while pos + 8 <= len(wav):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', wav, pos)
+        if chunk_id == b'data':
+            struct.pack_into('<I', wav, pos + 4, len(wav) - pos - 8)
+            break
+        pos += 8 + chunk_size + (chunk_size & 1)
+    struct.pack_into('<I', wav, 4, len(wav) - 8)
+    return bytes(wav)
+
+
+def amplify_wav(path, amplification):
+    """
+    Amplify the samples of a 16 or 32 bit PCM WAV file in place, saturating rather than
+    wrapping on overflow. The file is memory mapped and scaled a block at a time with numpy.
+
+    Args:
+        path: The WAV file to amplify
+        amplification: Integer factor to amplify the audio by
+
+    Returns:
+        False if numpy isn't available or the file isn't 16 or 32 bit, so the caller
+        has to amplify it some other way, otherwise True
+    """
+
+    if amplification == 1:
+        return True
+
+    with open(path, 'rb') as f:
+        _, _, _, bits, chunk_size = read_wav_header(f, path)
+        data_start = f.tell()
+        data_len = min(chunk_size, os.fstat(f.fileno()).st_size - data_start)
+
+    if np is None or bits not in (16, 32):
+        return False
+
+    dtype = np.dtype('<i{}'.format(bits // 8))
+    n_samples = data_len // dtype.itemsize
+    if n_samples == 0:
+        return True
+
+    info = np.iinfo(dtype)
+    samples = np.memmap(path, dtype=dtype, mode='r+', offset=data_start, shape=(n_samples,))
+    try:
+        for i in range(0, n_samples, AMPLIFY_BLOCK_SAMPLES):
+            block = samples[i:i + AMPLIFY_BLOCK_SAMPLES].astype(np.int64)
+            block *= amplification
+            np.clip(block, info.min, info.max, out=block)
+            samples[i:i + AMPLIFY_BLOCK_SAMPLES] = block
+        samples.flush()
+    finally:
+        del samples
+
+    return True
+
+
+def amplify_wav_to_s16(in_path, out_path, amplification):
+    """
+    Amplify a 32 bit PCM WAV file, saturating rather than wrapping on overflow, and write
+    it out as a 16 bit WAV file. Each sample keeps its high 16 bits, as ffmpeg's conversion
+    does, so the result matches what ffmpeg would have produced.
+
+    Args:
+        in_path: The 32 bit WAV file to read
+        out_path: Where to write the 16 bit WAV file
+        amplification: Integer factor to amplify the audio by
+
+    Returns:
+        False if numpy isn't available or the file isn't 32 bit, so the caller
+        has to convert it some other way, otherwise True
+    """
+
+    with open(in_path, 'rb') as f:
+        _, rate, block_align, bits, chunk_size = read_wav_header(f, in_path)
+        data_start = f.tell()
+        data_len = min(chunk_size, os.fstat(f.fileno()).st_size - data_start)
+
+    if np is None or bits != 32:
+        return False
+
+    channels = block_align // 4
+    n_samples = data_len // 4
+    out_len = n_samples * 2
+
+    header = struct.pack('<4sI4s', b'RIFF', 36 + out_len, b'WAVE')
+    header += struct.pack('<4sIHHIIHH', b'fmt ', 16, 1, channels, rate, rate * channels * 2, channels * 2, 16)
+    header += struct.pack('<4sI', b'data', out_len)
+
+    info = np.iinfo(np.int32)
+    with open(out_path, 'wb') as f_out:
+        f_out.write(header)
+        if n_samples == 0:
+            return True
+
+        samples = np.memmap(in_path, dtype='<i4', mode='r', offset=data_start, shape=(n_samples,))
+        try:
+            for i in range(0, n_samples, AMPLIFY_BLOCK_SAMPLES):
+                block = samples[i:i + AMPLIFY_BLOCK_SAMPLES].astype(np.int64)
+                if amplification != 1:
+                    block *= amplification
+                    np.clip(block, info.min, info.max, out=block)
+                block >>= 16
+                block.astype('<i2').tofile(f_out)
+        finally:
+            del samples
+
+    return True